@@ -0,0 +1,47 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   benchmark.py
+@Modify Time :   2023/3/20 15:00
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   run the synthetic benchmark and compare it with a baseline
+'''
+import argparse
+import os
+
+from util import bench_util
+
+parser = argparse.ArgumentParser(description='benchmark the load, filter, segment, speed and match stages.')
+parser.add_argument('--directory', default='./benchmark', help='the directory of the synthetic files.')
+parser.add_argument('--network', default='grid', choices=['grid', 'radial'])
+parser.add_argument('--size', type=int, default=10, help='grid rows and columns, or radial rings.')
+parser.add_argument('--cars', type=int, default=100)
+parser.add_argument('--duration', type=int, default=3600, help='seconds of every trajectory.')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--match', type=int, default=20, help='the number of matched segments, 0 skips match.')
+parser.add_argument('--backend', default=None, choices=['fmm', 'hmm'])
+parser.add_argument('--output', default='benchmark.json', help='the result json file.')
+parser.add_argument('--baseline', default=None, help='a result json file to compare with.')
+parser.add_argument('--tolerance', type=float, default=0.1)
+parser.add_argument('--check-tiles', action='store_true',
+                    help='also check that the tiled map build is the same as the build in one tile.')
+args = parser.parse_args()
+
+os.makedirs(args.directory, exist_ok=True)
+result = bench_util.run_benchmark(args.directory, args.network, args.size, car_number=args.cars,
+                                  duration=args.duration, repeat=args.repeat, match_number=args.match,
+                                  backend=args.backend)
+bench_util.save_result(result, args.output)
+for name, stage in result['stages'].items():
+    print(f'{name}: {stage["points_per_second"]:.0f} points/s, p50 {stage["latency_ms"]["p50"]:.3f} ms, '
+          f'p90 {stage["latency_ms"]["p90"]:.3f} ms, peak {stage["peak_memory"] / 1024 / 1024:.1f} MB')
+if args.baseline is not None:
+    comparison = bench_util.compare_results(result, bench_util.load_result(args.baseline), args.tolerance)
+    for name, ratio in comparison.items():
+        flag = 'REGRESSION' if ratio['regression'] else 'ok'
+        print(f'{name}: throughput x{ratio["throughput"]:.2f}, p90 x{ratio["p90"]:.2f}, '
+              f'peak memory x{ratio["peak_memory"]:.2f} {flag}')
+if args.check_tiles:
+    check = bench_util.check_tiled_map(os.path.join(args.directory, 'tiles'))
+    print(f'tiled map: {check["edges"][0]} edges, one tile map: {check["edges"][1]} edges, '
+          f'{check["missing"]} missing, {check["extra"]} extra {"ok" if check["same"] else "MISMATCH"}')
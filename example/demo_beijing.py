@@ -7,18 +7,19 @@
 @Desciption  :   a demo of Beijing
 '''
 import data.polygon_data as pd
-from util import map_util, draw_util, match_util, data_util
+from util import map_util, draw_util, match_util, data_util, io_util
 
 file_directory = './'
 edge_name = 'beijing_edge.shp'
 node_name = 'beijing_node.shp'
 origin_map_name = 'origin_beijing.txt'
 map_name = 'beijing.txt'
+csr_name = 'beijing_csr'
 # download and draw map.
 # 1. get polygon
 polygon = pd.get_beijing()
 # 2. download map
-map_util.download_map(polygon, file_directory, edge_name, node_name, origin_map_name, map_name)
+map_util.download_map(polygon, file_directory, edge_name, node_name, origin_map_name, map_name, csr_name=csr_name)
 # 3. load the map that before simplify as origin_G
 origin_G = map_util.load_map(file_directory, origin_map_name)
 # 4. draw origin_G.
@@ -29,29 +30,32 @@ G = map_util.load_map(file_directory, map_name)
 fig, ax = draw_util.draw_map(G)
 # import trajectory, preprocess data, match trajectory and draw it.
 data_path = 'xxx'
-ubodt_name = 'beijing_ubodt.txt'
+# None: use the binary ubodt cached by the hash of the edge shape file, it is generated only once.
+ubodt_name = None
 # 1. import trajectory data and preprocess it.
-car_traj = data_util.import_data(data_path, polygon=polygon)
-points_group = data_util.preprocess_data(car_traj)
+# the file is parsed in parallel byte ranges, data_path can also be a list of files.
+columns = data_util.import_files(data_path, polygon=polygon)
+segments = data_util.segment_columns(columns)
+points_group = [data_util.get_segment_points(columns, segment) for segment in segments]
 processed_points = []
-# 2. prepares tools for match
-network = match_util.get_network(file_directory, edge_name)
-graph = match_util.get_graph(network)
-match_util.gen_ubodt(network, graph, file_directory, ubodt_name)
-ubodt = match_util.get_ubodt(file_directory, ubodt_name)
-fmm_config = match_util.gen_match_config()
-# 3. match points
+# 2. prepares tools for match, the network, graph, ubodt and fmm model are loaded once.
+session = match_util.MatchSession(file_directory, edge_name, ubodt_name)
+print(session.report())
+# 3. match points in worker processes, the workers inherit the session.
 points_with_opath = []
 fix_trajectory = []
-for points in points_group:
-    try:
-        pwo, ft = match_util.match_points(ubodt, graph, network, points_group, fmm_config)
+results = match_util.match_fleet(points_group, file_directory, edge_name, ubodt_name, session=session)
+# the matched points and repaired trajectories are also saved as parquet files in result_directory.
+result_directory = './beijing_result'
+with io_util.ResultWriter(result_directory) as writer:
+    for points, (pwo, ft, error) in zip(points_group, results):
+        if error is not None:
+            print(error)
+            continue
+        writer.write_match(pwo, ft)
         points_with_opath += pwo
         fix_trajectory += ft
         processed_points += points
-    except Exception as e:
-        print(e)
-        continue
 # 4. draw origin trajectory and draw repaired trajectory
 # draw_util.draw_point(processed_points, ax, 'red', 1, 10)
 draw_util.draw_point(fix_trajectory, ax, 'red', 1, 10)
@@ -0,0 +1,189 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   aggregate_util.py
+@Modify Time :   2023/3/13 15:30
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   aggregate the speed of matched points by edge and time bin
+'''
+import numpy as np
+
+
+class SpeedAggregate:
+    """
+    The speed statistics of every (edge, time bin). The speeds are counted in a fixed histogram, so the median and
+    percentiles are estimated from it, and two aggregates can be merged without the points. It can be used to combine
+    the results of parallel or streaming runs. The added points are buffered and summed into the statistics when
+    they are read or when max_pending points are buffered, so adding small batches costs O(points).
+    The histogram costs 4 * bin_number bytes of every (edge, time bin), 480 bytes with the default bins.
+    """
+
+    def __init__(self, time_bin=900, speed_bin=0.5, max_speed=60.0, max_pending=1000000):
+        """
+        :param time_bin: the seconds of a time bin.
+        :param speed_bin: the width of a speed histogram bin, m/s.
+        :param max_speed: the upper bound of the speed histogram, m/s. A larger speed is counted in the last bin.
+        :param max_pending: the maximum number of buffered points.
+        """
+        self.time_bin = time_bin
+        self.speed_bin = speed_bin
+        self.max_speed = max_speed
+        self.max_pending = max_pending
+        self.bin_number = int(np.ceil(max_speed / speed_bin))
+        self._edge = np.zeros(0, dtype=np.int64)
+        self._time = np.zeros(0, dtype=np.int64)
+        self._count = np.zeros(0, dtype=np.int64)
+        self._total = np.zeros(0, dtype=np.float64)
+        self._histogram = np.zeros((0, self.bin_number), dtype=np.int32)
+        # a list of (edge, time bin, speed index, speed) arrays of the added points.
+        self._pending = []
+        self._pending_number = 0
+
+    @property
+    def edge(self) -> np.ndarray:
+        self._reduce_pending()
+        return self._edge
+
+    @property
+    def time(self) -> np.ndarray:
+        self._reduce_pending()
+        return self._time
+
+    @property
+    def count(self) -> np.ndarray:
+        self._reduce_pending()
+        return self._count
+
+    @property
+    def total(self) -> np.ndarray:
+        self._reduce_pending()
+        return self._total
+
+    @property
+    def histogram(self) -> np.ndarray:
+        self._reduce_pending()
+        return self._histogram
+
+    def _reduce(self, edge, time, count, total, histogram):
+        """
+        sum the statistics of the same (edge, time bin) and store them.
+        """
+        keys, inverse = np.unique(np.stack((edge, time), axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self._edge = keys[:, 0].copy()
+        self._time = keys[:, 1].copy()
+        self._count = np.bincount(inverse, weights=count, minlength=len(keys)).astype(np.int64)
+        self._total = np.bincount(inverse, weights=total, minlength=len(keys))
+        order = np.argsort(inverse, kind='stable')
+        starts = np.searchsorted(inverse[order], np.arange(len(keys)))
+        self._histogram = np.add.reduceat(histogram[order], starts, axis=0).astype(np.int32) if len(keys) != 0 else \
+            np.zeros((0, self.bin_number), dtype=np.int32)
+
+    def _reduce_pending(self):
+        """
+        sum the buffered points into the statistics.
+        """
+        if len(self._pending) == 0:
+            return
+        edge, time, speed_index, speed = (np.concatenate(values) for values in zip(*self._pending))
+        self._pending, self._pending_number = [], 0
+        keys, inverse = np.unique(np.stack((edge, time), axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        histogram = np.bincount(inverse * self.bin_number + speed_index,
+                                minlength=len(keys) * self.bin_number).reshape(len(keys), self.bin_number)
+        self._reduce(np.concatenate((self._edge, keys[:, 0])), np.concatenate((self._time, keys[:, 1])),
+                     np.concatenate((self._count, np.bincount(inverse, minlength=len(keys)))),
+                     np.concatenate((self._total, np.bincount(inverse, weights=speed, minlength=len(keys)))),
+                     np.concatenate((self._histogram, histogram)))
+
+    def add(self, edge, time, speed):
+        """
+        add matched points. The points whose edge is -1 or speed is NaN are ignored.
+        :param edge: the matched edge id array, the 'opath' of `match_util.match_points`.
+        :param time: the time array.
+        :param speed: the speed array, the 'speed_cal' of `data_util.gen_speed`.
+        """
+        edge = np.asarray(edge, dtype=np.int64)
+        time = np.asarray(time, dtype=np.int64)
+        speed = np.asarray(speed, dtype=np.float64)
+        valid = (edge >= 0) & ~np.isnan(speed)
+        edge, time, speed = edge[valid], time[valid], speed[valid]
+        if len(edge) == 0:
+            return
+        time = time // self.time_bin * self.time_bin
+        speed_index = np.clip((speed / self.speed_bin).astype(np.int64), 0, self.bin_number - 1)
+        self._pending.append((edge, time, speed_index, speed))
+        self._pending_number += len(edge)
+        if self._pending_number >= self.max_pending:
+            self._reduce_pending()
+
+    def add_points(self, points_with_opath: list):
+        """
+        add matched points.
+        :param points_with_opath: the points list returned by `match_util.match_points`.
+        """
+        self.add([point['opath'] for point in points_with_opath], [point['time'] for point in points_with_opath],
+                 [point.get('speed_cal', np.nan) for point in points_with_opath])
+
+    def merge(self, other: 'SpeedAggregate') -> 'SpeedAggregate':
+        """
+        merge another aggregate into this one.
+        :param other: an aggregate with the same time_bin, speed_bin and max_speed.
+        :return: self
+        """
+        if (other.time_bin, other.speed_bin, other.bin_number) != (self.time_bin, self.speed_bin, self.bin_number):
+            raise Exception('the aggregates have different bins.')
+        self._reduce(np.concatenate((self.edge, other.edge)), np.concatenate((self.time, other.time)),
+                     np.concatenate((self.count, other.count)), np.concatenate((self.total, other.total)),
+                     np.concatenate((self.histogram, other.histogram.astype(np.int32))))
+        return self
+
+    def percentile(self, q) -> np.ndarray:
+        """
+        estimate the speed percentile of every (edge, time bin) by linear interpolation in the histogram.
+        :param q: percentile in [0, 100].
+        :return: speed array.
+        """
+        if len(self.count) == 0:
+            return np.zeros(0)
+        cumulative = np.cumsum(self.histogram, axis=1)
+        target = q / 100 * self.count
+        index = np.minimum((cumulative < target[:, None]).sum(axis=1), self.bin_number - 1)
+        rows = np.arange(len(self.count))
+        before = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0)
+        in_bin = self.histogram[rows, index]
+        fraction = np.where(in_bin > 0, (target - before) / np.maximum(in_bin, 1), 0)
+        return (index + np.clip(fraction, 0, 1)) * self.speed_bin
+
+    def summary(self, percentiles=(15, 85)) -> dict:
+        """
+        :param percentiles: the percentiles besides the median.
+        :return: a dict of arrays, 'edge', 'time', 'count', 'mean', 'median' and 'p<q>' for every percentile q.
+        """
+        res = {'edge': self.edge, 'time': self.time, 'count': self.count,
+               'mean': self.total / np.maximum(self.count, 1), 'median': self.percentile(50)}
+        for q in percentiles:
+            res[f'p{q}'] = self.percentile(q)
+        return res
+
+    def save(self, file_path: str):
+        """
+        save the aggregate as npz.
+        :param file_path: file path.
+        """
+        np.savez(file_path, edge=self.edge, time=self.time, count=self.count, total=self.total,
+                 histogram=self.histogram, bins=np.array([self.time_bin, self.speed_bin, self.max_speed]))
+
+    @classmethod
+    def load(cls, file_path: str) -> 'SpeedAggregate':
+        """
+        load an aggregate saved by `save`.
+        :param file_path: file path.
+        :return: SpeedAggregate
+        """
+        data = np.load(file_path)
+        time_bin, speed_bin, max_speed = data['bins'].tolist()
+        res = cls(int(time_bin), speed_bin, max_speed)
+        res._edge, res._time, res._count = data['edge'], data['time'], data['count']
+        res._total, res._histogram = data['total'], data['histogram'].astype(np.int32)
+        return res
@@ -0,0 +1,436 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   bench_util.py
+@Modify Time :   2023/3/20 14:10
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   synthetic networks and trajectories, and a benchmark of the load, filter, segment, speed and match stages
+'''
+import contextlib
+import io
+import json
+import os
+import pickle
+import platform
+import time
+import tracemalloc
+
+import networkx
+import numpy as np
+import shapely
+from shapely.geometry import LineString
+
+from util import data_util, match_util
+
+# meters of one degree of latitude.
+METERS_PER_DEGREE = 111320.0
+BENCH_VERSION = 1
+
+
+def _add_edge(G, u, v, edge_id: int):
+    """
+    add an edge of straight line to the synthetic graph.
+    """
+    geometry = LineString([(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])])
+    G.add_edge(u, v, osmid=edge_id, highway='primary', length=geometry.length * METERS_PER_DEGREE,
+               geometry=geometry)
+
+
+def gen_grid_network(rows=10, columns=10, spacing=0.001, origin=(116.3, 39.9)) -> networkx.MultiDiGraph:
+    """
+    generate a grid road network, every two neighbor nodes are connected by two directed edges.
+    :param rows: the number of nodes in y.
+    :param columns: the number of nodes in x.
+    :param spacing: the distance of two neighbor nodes, degree.
+    :param origin: (x, y) of the lower left node.
+    :return: networkx.MultiDiGraph, the edge id is the 'osmid' attribute.
+    """
+    G = networkx.MultiDiGraph(crs='epsg:4326')
+    for i in range(columns):
+        for j in range(rows):
+            G.add_node(i * rows + j, x=origin[0] + i * spacing, y=origin[1] + j * spacing)
+    for i in range(columns):
+        for j in range(rows):
+            node = i * rows + j
+            for neighbor in ([node + rows] if i + 1 < columns else []) + ([node + 1] if j + 1 < rows else []):
+                _add_edge(G, node, neighbor, G.number_of_edges())
+                _add_edge(G, neighbor, node, G.number_of_edges())
+    return G
+
+
+def gen_radial_network(rings=5, spokes=8, spacing=0.001, center=(116.3, 39.9)) -> networkx.MultiDiGraph:
+    """
+    generate a radial road network of rings and spokes, every two neighbor nodes are connected by two directed edges.
+    :param rings: the number of rings.
+    :param spokes: the number of spokes.
+    :param spacing: the distance of two neighbor rings, degree.
+    :param center: (x, y) of the center node.
+    :return: networkx.MultiDiGraph, the edge id is the 'osmid' attribute.
+    """
+    G = networkx.MultiDiGraph(crs='epsg:4326')
+    G.add_node(0, x=center[0], y=center[1])
+    for r in range(1, rings + 1):
+        for s in range(spokes):
+            angle = 2 * np.pi * s / spokes
+            G.add_node(1 + (r - 1) * spokes + s, x=center[0] + r * spacing * np.cos(angle),
+                       y=center[1] + r * spacing * np.sin(angle))
+    for r in range(1, rings + 1):
+        for s in range(spokes):
+            node = 1 + (r - 1) * spokes + s
+            inner = 0 if r == 1 else node - spokes
+            neighbor = 1 + (r - 1) * spokes + (s + 1) % spokes
+            for u, v in ((inner, node), (node, neighbor)):
+                _add_edge(G, u, v, G.number_of_edges())
+                _add_edge(G, v, u, G.number_of_edges())
+    return G
+
+
+def save_network(G: networkx.MultiDiGraph, file_directory: str, edge_name: str, graph_name: str = None):
+    """
+    save the synthetic network in the formats of `map_util.download_map`: the edge shape file for match, and the
+    pickled graph for `map_util.load_map`.
+    :param G: the network.
+    :param file_directory: the directory.
+    :param edge_name: edge shape file name, its attributes are 'fid', 'u' and 'v'.
+    :param graph_name: the graph file name. If None, the graph is not saved.
+    """
+    import geopandas as gpd
+    os.makedirs(file_directory, exist_ok=True)
+    rows = [(data['osmid'], u, v, data['geometry']) for u, v, data in G.edges(data=True)]
+    gdf = gpd.GeoDataFrame({'fid': [row[0] for row in rows], 'u': [row[1] for row in rows],
+                            'v': [row[2] for row in rows]}, geometry=[row[3] for row in rows], crs='epsg:4326')
+    gdf.to_file(os.path.join(file_directory, edge_name))
+    if graph_name is not None:
+        with open(os.path.join(file_directory, graph_name), 'wb') as f:
+            pickle.dump(G, f)
+
+
+def gen_trajectories(G: networkx.MultiDiGraph, file_path: str, car_number=100, duration=3600, interval=5,
+                     speed=(5.0, 15.0), noise=5.0, gap_probability=0.01, gap_duration=300, invalid_probability=0.01,
+                     seed=0) -> dict:
+    """
+    drive cars along random walks of the network and write their GPS points in the raw tab-separated format of
+    `data_util.import_data`. Every point gets gaussian noise, a gap (no points for gap_duration seconds) begins at a
+    point with gap_probability, and a point is written as an invalid fix with invalid_probability.
+    :param G: the network.
+    :param file_path: the raw data file path.
+    :param car_number: the number of cars.
+    :param duration: the seconds of every trajectory.
+    :param interval: the seconds between two points.
+    :param speed: (minimum, maximum) of the speed of a car, m/s.
+    :param noise: the standard deviation of GPS noise, meters.
+    :param gap_probability: see above.
+    :param gap_duration: see above.
+    :param invalid_probability: see above.
+    :param seed: random seed.
+    :return: a dict of 'points' (the number of written valid points) and 'edges' (the true edge id of every written
+    valid point, in file order).
+    """
+    rng = np.random.default_rng(seed)
+    out_edges = {node: [(v, data) for _, v, data in G.out_edges(node, data=True)] for node in G.nodes}
+    nodes = [node for node in G.nodes if len(out_edges[node]) != 0]
+    step_number = duration // interval
+    lines, edges = [], []
+    for car in range(car_number):
+        node = nodes[rng.integers(len(nodes))]
+        car_speed = rng.uniform(*speed) / METERS_PER_DEGREE
+        target, data = out_edges[node][rng.integers(len(out_edges[node]))]
+        position = 0.0
+        gap_end = -1
+        begin_time = int(rng.integers(0, duration))
+        for step in range(step_number):
+            position += car_speed * interval
+            while position > data['geometry'].length:
+                position -= data['geometry'].length
+                node = target
+                target, data = out_edges[node][rng.integers(len(out_edges[node]))]
+            t = begin_time + step * interval
+            if t < gap_end:
+                continue
+            if rng.random() < gap_probability:
+                gap_end = t + gap_duration
+            point = data['geometry'].interpolate(position)
+            x = point.x + rng.normal(0, noise) / METERS_PER_DEGREE
+            y = point.y + rng.normal(0, noise) / METERS_PER_DEGREE
+            if rng.random() < invalid_probability:
+                valid = data_util.INVALID_FIX
+            else:
+                valid = '有效'
+                edges.append(data['osmid'])
+            lines.append(f'{len(lines)}\tcar{car}\t{t}\t{valid}\t{round(y * 100000)}\t{round(x * 100000)}\t0\t'
+                         f'{car_speed * METERS_PER_DEGREE:.1f}\n')
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+    return {'points': len(edges), 'edges': edges}
+
+
+def _latency(samples: list) -> dict:
+    """
+    :param samples: the seconds of every item.
+    :return: the latency percentiles, milliseconds.
+    """
+    if len(samples) == 0:
+        return {'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+    ms = np.asarray(samples) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99]).tolist()
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': float(ms.max())}
+
+
+def _run_stage(func, items: list, repeat: int) -> (list, dict):
+    """
+    run a stage on every item repeat times, and once more under tracemalloc to get its peak memory.
+    :param func: a function of an item.
+    :param items: items.
+    :param repeat: the number of timed runs.
+    :return: the results of the last run and the measure.
+    """
+    samples, total = [], 0.0
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        for item in items:
+            item_begin = time.perf_counter()
+            func(item)
+            samples.append(time.perf_counter() - item_begin)
+        total += time.perf_counter() - begin
+    tracemalloc.start()
+    results = [func(item) for item in items]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return results, {'items': len(items), 'seconds': total / repeat, 'latency_ms': _latency(samples),
+                     'peak_memory': peak}
+
+
+def _throughput(measure: dict, points: int):
+    """
+    add the number of points and points per second to a measure.
+    """
+    measure['points'] = points
+    measure['points_per_second'] = points / measure['seconds'] if measure['seconds'] > 0 else 0.0
+
+
+def run_benchmark(file_directory: str, network='grid', size=10, spacing=0.001, car_number=100, duration=3600,
+                  interval=5, noise=5.0, gap_probability=0.01, repeat=3, match_number=20, backend=None, k=4,
+                  radius=None, gps_error=None, seed=0) -> dict:
+    """
+    generate a synthetic network and trajectories in file_directory and measure every stage:
+    load (`data_util.import_data`), filter (`data_util.process_points`), segment (`data_util.preprocess_data`),
+    speed (`data_util.gen_speed`) and match (`match_util.MatchSession.match` of the first match_number segments).
+    :param file_directory: the directory of the generated files.
+    :param network: 'grid' or 'radial'.
+    :param size: the number of rows and columns of a grid, or the number of rings of a radial network.
+    :param spacing: see `gen_grid_network`.
+    :param car_number: see `gen_trajectories`.
+    :param duration: see `gen_trajectories`.
+    :param interval: see `gen_trajectories`.
+    :param noise: see `gen_trajectories`.
+    :param gap_probability: see `gen_trajectories`.
+    :param repeat: the number of timed runs of every stage.
+    :param match_number: the number of matched segments, 0 skips the match stage.
+    :param backend: see `match_util.MatchSession`. If None, 'fmm' is used if it is installed, otherwise 'hmm'.
+    :param k: see `match_util.MatchSession`.
+    :param radius: see `match_util.MatchSession`. If None, it is 0.3 * spacing.
+    :param gps_error: see `match_util.MatchSession`. If None, it is the noise in degree.
+    :param seed: random seed.
+    :return: a dict of 'meta' (the parameters and environment) and 'stages' (stage name to its measure: 'items',
+    'points', 'seconds', 'points_per_second', 'latency_ms' and 'peak_memory' in bytes).
+    """
+    if backend is None:
+        backend = 'fmm' if match_util.FMM_AVAILABLE else 'hmm'
+    radius = 0.3 * spacing if radius is None else radius
+    gps_error = max(noise, 1.0) / METERS_PER_DEGREE if gps_error is None else gps_error
+    if network == 'grid':
+        G = gen_grid_network(size, size, spacing)
+    elif network == 'radial':
+        G = gen_radial_network(size, 8, spacing)
+    else:
+        raise Exception(f'unknown network: {network}.')
+    edge_name = f'{network}_edge.shp'
+    data_path = os.path.join(file_directory, f'{network}_trajectory.txt')
+    save_network(G, file_directory, edge_name, f'{network}.txt')
+    truth = gen_trajectories(G, data_path, car_number, duration, interval, noise=noise,
+                             gap_probability=gap_probability, seed=seed)
+    x = [data['x'] for _, data in G.nodes(data=True)]
+    y = [data['y'] for _, data in G.nodes(data=True)]
+    polygon = shapely.box(min(x), min(y), max(x), max(y)).buffer(spacing)
+    stages = {}
+
+    def load(path):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return data_util.import_data(path)
+
+    results, stages['load'] = _run_stage(load, [data_path], repeat)
+    trajectories = list(results[0].values())
+    _throughput(stages['load'], sum(len(points) for points in trajectories))
+
+    def process(points):
+        return data_util.process_points([dict(point) for point in points], 0, 2 * duration, polygon, True)
+
+    trajectories, stages['filter'] = _run_stage(process, trajectories, repeat)
+    _throughput(stages['filter'], sum(len(points) for points in trajectories))
+
+    segments, stages['segment'] = _run_stage(data_util.preprocess_data, trajectories, repeat)
+    segments = [points for group in segments for points in group]
+    _throughput(stages['segment'], sum(len(points) for points in trajectories))
+
+    _, stages['speed'] = _run_stage(data_util.gen_speed, segments, repeat)
+    _throughput(stages['speed'], sum(len(points) for points in segments))
+
+    meta = {'version': BENCH_VERSION, 'network': network, 'size': size, 'spacing': spacing,
+            'edges': G.number_of_edges(), 'car_number': car_number, 'duration': duration, 'interval': interval,
+            'noise': noise, 'gap_probability': gap_probability, 'repeat': repeat, 'seed': seed,
+            'raw_points': truth['points'], 'python': platform.python_version(), 'numpy': np.__version__,
+            'shapely': shapely.__version__, 'machine': platform.machine(), 'processor': platform.processor()}
+    if match_number > 0 and len(segments) != 0:
+        begin = time.perf_counter()
+        session = match_util.MatchSession(file_directory, edge_name, k=k, radius=radius, gps_error=gps_error,
+                                          backend=backend)
+        meta.update({'backend': backend, 'k': k, 'radius': radius, 'gps_error': gps_error,
+                     'session_load_seconds': time.perf_counter() - begin})
+        matched = segments[:match_number]
+        _, stages['match'] = _run_stage(session.match, matched, repeat)
+        _throughput(stages['match'], sum(len(points) for points in matched))
+    return {'meta': meta, 'stages': stages}
+
+
+def gen_osm_file(file_path: str, size=0.15, anchors=60, spacing=0.0005, long_road=0.12, origin=(116.3, 39.9),
+                 seed=0) -> shapely.Polygon:
+    """
+    generate an OSM extract that is not a grid: random junctions joined to their nearest junctions by ways with a node
+    every spacing, and one long road of long_road degrees with junctions only at its ends. Every way crosses many
+    tiles of `map_util.build_map` without a junction at the tile borders.
+    :param file_path: the .osm file path.
+    :param size: the width and height of the extract, degree.
+    :param anchors: the number of junctions.
+    :param spacing: the distance of two nodes of a way, degree.
+    :param long_road: the length of the long road, degree.
+    :param origin: (x, y) of the lower left corner.
+    :param seed: random seed.
+    :return: the boundaries of the extract.
+    """
+    rng = np.random.default_rng(seed)
+    junctions = np.column_stack([origin[0] + rng.uniform(0.01, size - 0.01, anchors),
+                                 origin[1] + rng.uniform(0.01, size - 0.01, anchors)])
+    start = (origin[0] + (size - long_road) / 2, origin[1] + size / 2 + 0.003)
+    junctions = np.vstack([junctions, start, (start[0] + long_road, start[1])])
+    pairs = {(i, anchors + 1) for i in [anchors]}
+    for i in range(anchors):
+        distance = np.hypot(*(junctions[:anchors] - junctions[i]).T)
+        pairs.update((min(i, j), max(i, j)) for j in np.argsort(distance)[1:4].tolist())
+    # the long road is joined to the network only at its ends.
+    for end in (anchors, anchors + 1):
+        nearest = int(np.argmin(np.hypot(*(junctions[:anchors] - junctions[end]).T)))
+        pairs.add((nearest, end))
+    nodes = [(i + 1, x, y) for i, (x, y) in enumerate(junctions.tolist())]
+    ways = []
+    highways = ['primary', 'secondary', 'tertiary', 'trunk']
+    for i, j in sorted(pairs):
+        number = max(int(np.hypot(*(junctions[j] - junctions[i])) / spacing), 1)
+        refs = [i + 1]
+        for step in range(1, number):
+            x, y = junctions[i] + (junctions[j] - junctions[i]) * step / number
+            nodes.append((len(nodes) + 1, x, y))
+            refs.append(len(nodes))
+        refs.append(j + 1)
+        ways.append((refs, highways[len(ways) % len(highways)], 'yes' if len(ways) % 5 == 0 else 'no'))
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version='0.6' generator='bench_util'>\n")
+        for node_id, x, y in nodes:
+            f.write(f"<node id='{node_id}' lat='{y:.7f}' lon='{x:.7f}' version='1'/>\n")
+        for way_id, (refs, highway, oneway) in enumerate(ways):
+            f.write(f"<way id='{way_id + 1}' version='1'>" + ''.join(f"<nd ref='{ref}'/>" for ref in refs) +
+                    f"<tag k='highway' v='{highway}'/><tag k='oneway' v='{oneway}'/></way>\n")
+        f.write('</osm>\n')
+    return shapely.box(origin[0], origin[1], origin[0] + size, origin[1] + size)
+
+
+def _edge_signature(G: networkx.MultiDiGraph, digits: int) -> list:
+    """
+    :return: the sorted (start, end, length) of the edges, rounded, it does not depend on the node and edge ids.
+    """
+    res = []
+    for u, v, data in G.edges(data=True):
+        start = (round(G.nodes[u]['x'], digits), round(G.nodes[u]['y'], digits))
+        end = (round(G.nodes[v]['x'], digits), round(G.nodes[v]['y'], digits))
+        res.append((start, end, round(data['geometry'].length, digits)))
+    return sorted(res)
+
+
+def check_tiled_map(file_directory: str, tile_size=0.05, overlap=0.005, digits=5, seed=0, **kwargs) -> dict:
+    """
+    the regression check of the tiled map build: build a map of the extract of `gen_osm_file` with tiles and with one
+    tile, the two maps should have the same edges.
+    :param file_directory: the directory of the extract and the maps.
+    :param tile_size: see `map_util.build_map`.
+    :param overlap: see `map_util.build_map`.
+    :param digits: the coordinates and lengths are compared rounded to digits.
+    :param seed: see `gen_osm_file`.
+    :param kwargs: other parameters of `map_util.build_map`.
+    :return: a dict of 'edges' and 'length' (total degree) of the two maps as (tiled, one tile), 'missing' and
+    'extra', the number of edges only in the one tile map and only in the tiled map, and 'same'.
+    """
+    from util import map_util
+    os.makedirs(file_directory, exist_ok=True)
+    osm_path = os.path.join(file_directory, 'extract.osm')
+    polygon = gen_osm_file(osm_path, seed=seed)
+    res = {}
+    for name, size in (('tiled', tile_size), ('one', 10 * polygon.length)):
+        directory = os.path.join(file_directory, name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            map_util.build_map(osm_path, polygon, directory, 'edges.shp', 'nodes.shp', 'origin_graph.txt',
+                               'graph.txt', tile_size=size, overlap=overlap, cache_directory=os.path.join(
+                                   directory, 'tile_cache'), **kwargs)
+        res[name] = map_util.load_map(directory, 'graph.txt')
+    tiled, one = _edge_signature(res['tiled'], digits), _edge_signature(res['one'], digits)
+    missing, extra = list(one), []
+    for edge in tiled:
+        if edge in missing:
+            missing.remove(edge)
+        else:
+            extra.append(edge)
+    return {'edges': (len(tiled), len(one)),
+            'length': (sum(edge[2] for edge in tiled), sum(edge[2] for edge in one)),
+            'missing': len(missing), 'extra': len(extra), 'same': len(missing) == 0 and len(extra) == 0}
+
+
+def save_result(result: dict, file_path: str):
+    """
+    save a benchmark result as json.
+    :param result: see `run_benchmark`.
+    :param file_path: json file path.
+    """
+    with open(file_path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+def load_result(file_path: str) -> dict:
+    """
+    load a benchmark result saved by `save_result`.
+    :param file_path: json file path.
+    :return: see `run_benchmark`.
+    """
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def compare_results(result: dict, baseline: dict, tolerance=0.1) -> dict:
+    """
+    compare a benchmark result with a baseline of the same parameters.
+    :param result: see `run_benchmark`.
+    :param baseline: see `run_benchmark`.
+    :param tolerance: a stage regresses if its throughput drops, or its p90 latency or peak memory grows, by more
+    than this ratio.
+    :return: a dict of stage name to {'throughput': result / baseline, 'p90': result / baseline, 'peak_memory':
+    result / baseline, 'regression': bool}. The stages not in both results are skipped.
+    """
+    res = {}
+    for name, stage in result['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        base = baseline['stages'][name]
+        ratio = {'throughput': stage['points_per_second'] / max(base['points_per_second'], 1e-12),
+                 'p90': stage['latency_ms']['p90'] / max(base['latency_ms']['p90'], 1e-12),
+                 'peak_memory': stage['peak_memory'] / max(base['peak_memory'], 1)}
+        ratio['regression'] = bool(ratio['throughput'] < 1 - tolerance or ratio['p90'] > 1 + tolerance or
+                                   ratio['peak_memory'] > 1 + tolerance)
+        res[name] = ratio
+    return res
@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   cache_util.py
+@Modify Time :   2023/3/15 10:20
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   cache the match results of repeated routes
+'''
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _positions(x, y) -> np.ndarray:
+    """
+    :param x: x array.
+    :param y: y array.
+    :return: the normalized length along the trajectory of every point, from 0 to 1.
+    """
+    length = np.concatenate(([0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+    if length[-1] == 0:
+        return np.linspace(0, 1, len(x)) if len(x) > 1 else np.zeros(len(x))
+    return length / length[-1]
+
+
+class MatchCache:
+    """
+    A LRU cache of match results. The key is a fingerprint of the trajectory: the trajectory is resampled to
+    sample_number points evenly along its length and quantized to resolution, so near-identical trajectories (e.g.
+    the same bus route) have the same key even if they have different points. For a hit, every point gets the edge of
+    the cached point at the nearest position along the trajectory.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=256 * 1024 * 1024, resolution=5e-4, sample_number=16,
+                 file_path: str = None):
+        """
+        :param max_entries: the maximum number of cached results.
+        :param max_bytes: the maximum total size of the cached arrays.
+        :param resolution: the grid size of the quantized fingerprint, in the unit of the coordinates.
+        :param sample_number: the number of resampled points of the fingerprint.
+        :param file_path: if not None, the cache is loaded from it if it exists and `save` writes it.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.resolution = resolution
+        self.sample_number = sample_number
+        self.file_path = file_path
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        if file_path is not None and os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                for key, value in pickle.load(f):
+                    self._put(key, value)
+
+    def fingerprint(self, x, y, config_key) -> str:
+        """
+        :param x: x array.
+        :param y: y array.
+        :param config_key: a hashable description of the match config, it is a part of the key.
+        :return: the key of the trajectory.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        samples = np.linspace(0, 1, self.sample_number)
+        position = _positions(x, y)
+        grid = np.round(np.stack((np.interp(samples, position, x), np.interp(samples, position, y))) /
+                        self.resolution).astype(np.int64)
+        sha1 = hashlib.sha1(repr(config_key).encode('utf-8'))
+        sha1.update(grid.tobytes())
+        return sha1.hexdigest()
+
+    def _put(self, key: str, value: dict):
+        """
+        store a value and evict the least recently used values if the limits are exceeded.
+        """
+        if key in self._entries:
+            self.bytes -= sum(v.nbytes for v in self._entries.pop(key).values())
+        self._entries[key] = value
+        self.bytes += sum(v.nbytes for v in value.values())
+        while len(self._entries) > self.max_entries or (self.bytes > self.max_bytes and len(self._entries) > 1):
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= sum(v.nbytes for v in evicted.values())
+
+    def get(self, key: str, x, y) -> dict:
+        """
+        get the match result of a trajectory.
+        :param key: see `fingerprint`.
+        :param x: x array of the trajectory.
+        :param y: y array of the trajectory.
+        :return: a dict like `match_util.match_arrays` without 'speed', None if it is not cached.
+        """
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        position = _positions(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        cached = value['position']
+        if len(cached) == 1:
+            index = np.zeros(len(position), dtype=np.int64)
+        else:
+            # the nearest of the two cached points around every position.
+            index = np.clip(np.searchsorted(cached, position), 1, len(cached) - 1)
+            index = np.where(position - cached[index - 1] <= cached[index] - position, index - 1, index)
+        n = len(position)
+        return {'offsets': np.array([0, n], dtype=np.int64), 'opath': value['opath'][index],
+                'cpath': value['cpath'], 'cpath_offsets': np.array([0, len(value['cpath'])], dtype=np.int64),
+                'mgeom_x': value['mgeom_x'], 'mgeom_y': value['mgeom_y'],
+                'mgeom_offsets': np.array([0, len(value['mgeom_x'])], dtype=np.int64)}
+
+    def put(self, key: str, x, y, result: dict):
+        """
+        cache the match result of a trajectory. Only a result of one matched continuous part is cached.
+        :param key: see `fingerprint`.
+        :param x: x array of the trajectory.
+        :param y: y array of the trajectory.
+        :param result: the result of `match_util.match_arrays`.
+        """
+        if len(result['offsets']) != 2 or len(result['opath']) == 0 or (result['opath'] < 0).any():
+            return
+        self._put(key, {'position': _positions(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)),
+                        'opath': result['opath'].copy(), 'cpath': result['cpath'].copy(),
+                        'mgeom_x': result['mgeom_x'].copy(), 'mgeom_y': result['mgeom_y'].copy()})
+
+    def hit_rate(self) -> float:
+        """
+        :return: hits / (hits + misses).
+        """
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def save(self):
+        """
+        write the cache to file_path.
+        """
+        if self.file_path is None:
+            return
+        temp_path = f'{self.file_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(list(self._entries.items()), f)
+        os.replace(temp_path, self.file_path)
+
+    def __len__(self):
+        return len(self._entries)
@@ -6,13 +6,42 @@
 @Version     :   1.0
 @Desciption  :   None
 '''
-import codecs
-import copy
+import multiprocessing
+import os
+
 import numpy as np
-from geopy.distance import geodesic
-from shapely.geometry import Point
+import shapely
+
+from util import metrics_util
+
+
+def contains_points(polygon, x, y) -> np.ndarray:
+    """
+    test whether the points are in the polygon. The points out of the polygon's bounding box are rejected first,
+    the others are tested against the prepared polygon in one vectorized call.
+    :param polygon: the boundaries of map.
+    :param x: longitude array.
+    :param y: latitude array.
+    :return: a boolean mask, True if the point is in the polygon.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    min_x, min_y, max_x, max_y = polygon.bounds
+    mask = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+    index = np.flatnonzero(mask)
+    if len(index) == 0:
+        return mask
+    if hasattr(shapely, 'contains_xy'):
+        shapely.prepare(polygon)
+        mask[index] = shapely.contains_xy(polygon, x[index], y[index])
+    else:
+        # shapely < 2.0
+        from shapely import vectorized
+        mask[index] = vectorized.contains(polygon, x[index], y[index])
+    return mask
 
 
+@metrics_util.timed('filter')
 def process_points(points, time_begin, time_end, polygon, need_polygon: bool) -> list:
     """
     preprocess trajectory, include these operations:
@@ -33,108 +62,742 @@ def process_points(points, time_begin, time_end, polygon, need_polygon: bool) ->
             continue
         point['x'] = point['longitude']
         point['y'] = point['latitude']
-        if need_polygon:
-            if polygon.contains(Point(point['x'], point['y'])):
-                res.append(point)
-        else:
-            res.append(point)
+        res.append(point)
+    if need_polygon and len(res) != 0:
+        mask = contains_points(polygon, [point['x'] for point in res], [point['y'] for point in res])
+        res = [point for point, valid in zip(res, mask) if valid]
+    metrics_util.count('points_filtered', len(points) - len(res))
     return res
 
 
+INVALID_FIX = '定位无效'
+COLUMN_NAMES = ('time', 'latitude', 'longitude', 'speed')
+
+
+def _to_array(values: list, dtype) -> np.ndarray:
+    """
+    convert a list of raw byte fields to a numpy array. Fields that can not be converted become NaN.
+    :param values: raw byte fields.
+    :param dtype: target dtype.
+    :return: numpy array (float64 if some field is malformed).
+    """
+    try:
+        return np.array(values, dtype=dtype)
+    except ValueError:
+        res = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                res[i] = float(value)
+            except ValueError:
+                continue
+        return res
+
+
+def _parse_bytes(data: bytes) -> dict:
+    """
+    parse raw tab-separated records into columns. Only the car_id is decoded, the numeric fields are converted
+    column by column.
+    :param data: raw bytes of some complete lines.
+    :return: a dict of columns, the records are in file order.
+    """
+    lines = data.split(b'\n')
+    invalid = INVALID_FIX.encode('utf-8')
+    fields = [line.split(b'\t') for line in lines if len(line) != 0 and invalid not in line]
+    fields = [columns for columns in fields if len(columns) > 7]
+    car_id = np.array([columns[1].decode('utf-8') for columns in fields], dtype=str)
+    time = _to_array([columns[2] for columns in fields], np.int64)
+    latitude = _to_array([columns[4] for columns in fields], np.float64) / 100000
+    longitude = _to_array([columns[5] for columns in fields], np.float64) / 100000
+    speed = _to_array([columns[7].strip() for columns in fields], np.float64)
+    # drop the malformed records.
+    valid = ~(np.isnan(time.astype(np.float64)) | np.isnan(latitude) | np.isnan(longitude))
+    return {'car_id': car_id[valid], 'time': time[valid].astype(np.int64), 'latitude': latitude[valid],
+            'longitude': longitude[valid], 'speed': speed[valid]}
+
+
+def _filter_records(records: dict, time_begin: int = None, time_end: int = None, polygon=None) -> dict:
+    """
+    filter the parsed records by time window and polygon.
+    :param records: parsed records, see `_parse_bytes`.
+    :param time_begin: see `import_columns`.
+    :param time_end: see `import_columns`.
+    :param polygon: see `import_columns`.
+    :return: the filtered records.
+    """
+    valid = np.ones(len(records['time']), dtype=bool)
+    if time_begin is not None and time_end is not None:
+        valid &= (records['time'] >= time_begin) & (records['time'] <= time_end)
+    if polygon is not None:
+        valid &= contains_points(polygon, records['longitude'], records['latitude'])
+    return {key: value[valid] for key, value in records.items()}
+
+
+def _group_records(records: dict) -> dict:
+    """
+    group records by car and sort each car's records by time.
+    :param records: parsed records, see `_parse_bytes`.
+    :return: the columns, see `import_columns`.
+    """
+    order = np.lexsort((records['time'], records['car_id']))
+    car_id = records['car_id'][order]
+    if len(car_id) == 0:
+        car_ids, starts = np.array([], dtype=str), np.array([], dtype=np.int64)
+    else:
+        car_ids, starts = np.unique(car_id, return_index=True)
+    columns = {'car_id': car_ids, 'offsets': np.append(starts, len(car_id)).astype(np.int64)}
+    for name in COLUMN_NAMES:
+        columns[name] = records[name][order]
+    return columns
+
+
+def import_columns(file_path: str, time_begin: int = None, time_end: int = None, polygon=None,
+                   chunk_size=1024 * 1024) -> dict:
+    """
+    import data into numpy columns. The records are grouped by car and sorted by time, the records of the i-th car
+    are `columns[name][offsets[i]:offsets[i + 1]]`. Records of one car don't need to be contiguous in the file.
+    :param file_path: the data file path.
+    :param time_begin: a filter. If not None and record's time < time_begin, this record will be discarded. It takes effect only when time_begin and time_end are both not None.
+    :param time_end: a filter. If not None and record's time > time_end, this record will be discarded. It takes effect only when time_begin and time_end are both not None.
+    :param polygon: a filter. If not Node and record's position not in polygon, this record will be discarded.
+    :param chunk_size: the file is parsed in newline-aligned byte ranges of about chunk_size, so only the columns
+    and one range are in memory.
+    :return: a dict of columns. 'car_id' and 'offsets' describe the cars, 'time', 'latitude', 'longitude' and
+    'speed' are the records.
+    """
+    with metrics_util.timer('load'):
+        results = [_read_range((file_path, begin, end, time_begin, time_end, polygon))
+                   for begin, end in _byte_ranges(file_path, chunk_size)]
+        return _group_records(_merge_ranges(results))
+
+
+def _byte_ranges(file_path: str, chunk_size: int) -> list:
+    """
+    split a file to byte ranges of about chunk_size, every range ends after a newline or at the end of file.
+    :param file_path: the data file path.
+    :param chunk_size: bytes.
+    :return: a list of (begin, end).
+    """
+    size = os.path.getsize(file_path)
+    ranges = []
+    begin = 0
+    with open(file_path, 'rb') as f:
+        while begin < size:
+            f.seek(min(begin + chunk_size, size))
+            # move to the end of the line, it is the end of file if the seek reached it.
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((begin, end))
+            begin = end
+    return ranges
+
+
+def _read_range(args: tuple) -> (dict, int):
+    """
+    parse and filter a byte range of a file in a worker process.
+    :param args: (file_path, begin, end, time_begin, time_end, polygon).
+    :return: the filtered records, see `_parse_bytes`, and the number of parsed records.
+    """
+    file_path, begin, end, time_begin, time_end, polygon = args
+    with open(file_path, 'rb') as f:
+        f.seek(begin)
+        records = _parse_bytes(f.read(end - begin))
+    return _filter_records(records, time_begin, time_end, polygon), len(records['time'])
+
+
+def _merge_ranges(results: list) -> dict:
+    """
+    concatenate the records of byte ranges and count the read and filtered points.
+    :param results: a list of the results of `_read_range`.
+    :return: the records, see `_parse_bytes`.
+    """
+    parts = [records for records, _ in results]
+    n = sum(count for _, count in results)
+    if len(parts) == 0:
+        parts = [_parse_bytes(b'')]
+    records = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    metrics_util.count('points_read', n)
+    metrics_util.count('points_filtered', n - len(records['time']))
+    return records
+
+
+def import_files(file_paths, time_begin: int = None, time_end: int = None, polygon=None, workers: int = None,
+                 chunk_size=64 * 1024 * 1024) -> dict:
+    """
+    import data files in parallel. Every file is split to newline-aligned byte ranges of about chunk_size, the ranges
+    are parsed and filtered in worker processes, then the records are merged, grouped by car and sorted by time. The
+    records of one car can be in any ranges and files.
+    :param file_paths: a data file path or a list of them.
+    :param time_begin: see `import_columns`.
+    :param time_end: see `import_columns`.
+    :param polygon: see `import_columns`.
+    :param workers: the number of worker processes. If None, use all cores.
+    :param chunk_size: the bytes of a range.
+    :return: see `import_columns`.
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    tasks = [(file_path, begin, end, time_begin, time_end, polygon)
+             for file_path in file_paths for begin, end in _byte_ranges(file_path, chunk_size)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with metrics_util.timer('load'):
+        if workers == 1 or len(tasks) <= 1:
+            results = list(map(_read_range, tasks))
+        else:
+            with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+                results = pool.map(_read_range, tasks, chunksize=1)
+        return _group_records(_merge_ranges(results))
+
+
+def get_car_points(columns: dict, car_index: int) -> list:
+    """
+    get the trajectory of one car as points list.
+    :param columns: columns, see `import_columns`.
+    :param car_index: the index of car in columns['car_id'].
+    :return: trajectory points list.
+    """
+    begin, end = columns['offsets'][car_index], columns['offsets'][car_index + 1]
+    car_id = str(columns['car_id'][car_index])
+    values = [columns[name][begin:end].tolist() for name in COLUMN_NAMES]
+    return [{'car_id': car_id, 'time': time, 'latitude': latitude, 'longitude': longitude, 'speed': speed}
+            for time, latitude, longitude, speed in zip(*values)]
+
+
 def import_data(file_path: str, time_begin: int = None, time_end: int = None, polygon=None) -> {str: []}:
     """
-    import data.
+    import data. It is a view of `import_columns`, use `import_columns` directly for large data.
     :param file_path: the data file path.
     :param time_begin: a filter. If not None and record's time < time_begin, this record will be discarded. It takes effect only when time_begin and time_end are both not None.
     :param time_end: a filter. If not None and record's time > time_end, this record will be discarded. It takes effect only when time_begin and time_end are both not None.
     :param polygon: a filter. If not Node and record's position not in polygon, this record will be discarded.
     :return: a dict of data. Key is car_id, value is a list of trajectory.
     """
+    columns = import_columns(file_path, time_begin, time_end, polygon)
     res = {}
-    with codecs.open(file_path, 'r', 'utf-8') as f:
-        for line in f:
-            if line.__contains__('定位无效'):
-                continue
-            row = {}
-            try:
-                columns = line.split('\t')
-                row['car_id'] = columns[1]
-                row['time'] = int(columns[2])
-                row['latitude'] = float(columns[4]) / 100000
-                row['longitude'] = float(columns[5]) / 100000
-                row['speed'] = columns[7]
-                if not car_id.__eq__(row['car_id']) and len(data) != 0:
-                    # begin a new car data.
-                    if len(data) > 10:
-                        print(f'finished:{car_id}, numbers:{len(data)}')
-                    else:
-                        print(f'discard:{car_id}, numbers:{len(data)}')
-                    data.sort(key=lambda node: node['time'])
-                    res[car_id] = copy.deepcopy(data)
-                    data = []
-                valid = True
-                if time_begin is not None and time_end is not None:
-                    valid = valid and time_begin <= row['time'] <= time_end
-                if polygon is not None:
-                    valid = valid and polygon.contains(Point(row['longitude'], row['latitude']))
-                if valid:
-                    data.append(row)
-                car_id = row['car_id']
-            except Exception as e:
-                print(e)
-                continue
-        data.sort(key=lambda node: node['time'])
-        res[car_id] = data
+    for i in range(len(columns['car_id'])):
+        points = get_car_points(columns, i)
+        if len(points) > 10:
+            print(f'finished:{columns["car_id"][i]}, numbers:{len(points)}')
+        else:
+            print(f'discard:{columns["car_id"][i]}, numbers:{len(points)}')
+        res[str(columns['car_id'][i])] = points
     return res
 
 
-def gen_speed(points:list):
+def iter_car_points(file_path: str, time_begin: int = None, time_end: int = None, polygon=None,
+                    chunk_size=1024 * 1024, max_records=1000000):
+    """
+    import data one car at a time, the file is parsed in newline-aligned byte ranges of about chunk_size. The
+    records of a car are yielded once a range does not have it, so the memory is bounded by the cars of the recent
+    ranges if a car's records are close to each other in the file, e.g. a dump sorted by car. If more than
+    max_records records are buffered, the largest cars are yielded early. The records of a car yielded early or
+    appearing again later are yielded as another trajectory of the car.
+    :param file_path: the data file path.
+    :param time_begin: see `import_columns`.
+    :param time_end: see `import_columns`.
+    :param polygon: see `import_columns`.
+    :param chunk_size: bytes.
+    :param max_records: the maximum number of buffered records.
+    :return: a generator of trajectory points lists, see `get_car_points`.
+    """
+    # car_id -> a list of the columns of the car in the ranges.
+    buffers = {}
+    buffered = 0
+    for begin, end in _byte_ranges(file_path, chunk_size):
+        with metrics_util.timer('load'):
+            columns = _group_records(_merge_ranges([_read_range((file_path, begin, end, time_begin, time_end,
+                                                                 polygon))]))
+        offsets = columns['offsets'].tolist()
+        for i, car_id in enumerate(columns['car_id'].tolist()):
+            buffers.setdefault(car_id, []).append({name: columns[name][offsets[i]:offsets[i + 1]]
+                                                   for name in COLUMN_NAMES})
+            buffered += offsets[i + 1] - offsets[i]
+        present = set(columns['car_id'].tolist())
+        done = [car_id for car_id in buffers if car_id not in present]
+        if buffered > max_records:
+            sizes = {car_id: sum(len(part['time']) for part in parts) for car_id, parts in buffers.items()}
+            left = buffered - sum(sizes[car_id] for car_id in done)
+            for car_id in sorted(present, key=lambda car_id: -sizes[car_id]):
+                if left <= max_records // 2:
+                    break
+                done.append(car_id)
+                left -= sizes[car_id]
+        for car_id in done:
+            parts = buffers.pop(car_id)
+            buffered -= sum(len(part['time']) for part in parts)
+            yield _car_points(car_id, parts)
+    for car_id, parts in buffers.items():
+        yield _car_points(car_id, parts)
+
+
+def _car_points(car_id: str, parts: list) -> list:
+    """
+    :param car_id: car id.
+    :param parts: a list of the columns of the car, see `iter_car_points`.
+    :return: the trajectory points list of the car sorted by time, see `get_car_points`.
+    """
+    order = np.argsort(np.concatenate([part['time'] for part in parts]), kind='stable')
+    columns = {name: np.concatenate([part[name] for part in parts])[order] for name in COLUMN_NAMES}
+    columns['car_id'] = np.array([car_id])
+    columns['offsets'] = np.array([0, len(order)])
+    return get_car_points(columns, 0)
+
+
+EARTH_RADIUS = 6371008.8
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+
+def distance(x1, y1, x2, y2, method='ellipsoid') -> np.ndarray:
+    """
+    calculate the distance between points in meters.
+    :param x1: longitude array of the first points.
+    :param y1: latitude array of the first points.
+    :param x2: longitude array of the second points.
+    :param y2: latitude array of the second points.
+    :param method: 'haversine' uses a sphere, it is the fastest. 'ellipsoid' uses Lambert's formula on the WGS84
+    ellipsoid, its error is about 10 meters over thousands of kilometers.
+    :return: distance array.
+    """
+    x1, y1, x2, y2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (x1, y1, x2, y2))
+    if method == 'haversine':
+        h = np.sin((y2 - y1) / 2) ** 2 + np.cos(y1) * np.cos(y2) * np.sin((x2 - x1) / 2) ** 2
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    if method != 'ellipsoid':
+        raise Exception(f'unknown distance method: {method}.')
+    # reduced latitudes
+    b1 = np.arctan((1 - WGS84_F) * np.tan(y1))
+    b2 = np.arctan((1 - WGS84_F) * np.tan(y2))
+    h = np.sin((b2 - b1) / 2) ** 2 + np.cos(b1) * np.cos(b2) * np.sin((x2 - x1) / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    p = (b1 + b2) / 2
+    q = (b2 - b1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        big_x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / np.cos(sigma / 2) ** 2
+        big_y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / np.sin(sigma / 2) ** 2
+    correction = np.where(sigma > 0, big_x + big_y, 0)
+    return WGS84_A * (sigma - WGS84_F / 2 * correction)
+
+
+@metrics_util.timed('speed')
+def compute_speed(x, y, t, offsets=None, method='ellipsoid') -> np.ndarray:
+    """
+    calculate speed of trajectories. The speed of a point is the speed to the next point, the last point of a
+    trajectory uses the speed of the point before it. If two consecutive points have the same time, the speed of the
+    point before is carried forward (0 for the first point).
+    :param x: longitude array.
+    :param y: latitude array.
+    :param t: time array in seconds.
+    :param offsets: the i-th trajectory is `[offsets[i], offsets[i + 1])`. If None, all points are one trajectory.
+    :param method: see `distance`.
+    :return: speed array in m/s.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    n = len(t)
+    if n == 0:
+        return np.zeros(0)
+    if offsets is None:
+        offsets = np.array([0, n])
+    offsets = np.asarray(offsets, dtype=np.int64)
+    is_first = np.zeros(n, dtype=bool)
+    is_first[offsets[:-1][offsets[:-1] < n]] = True
+    is_last = np.zeros(n, dtype=bool)
+    is_last[offsets[1:][offsets[1:] > 0] - 1] = True
+    dt = t[1:] - t[:-1]
+    # a pair is valid if both points are in the same trajectory and the time is different.
+    valid = (dt != 0) & ~is_last[:-1]
+    speed = np.zeros(n)
+    pair = np.flatnonzero(valid)
+    speed[pair] = distance(x[pair], y[pair], x[pair + 1], y[pair + 1], method) / dt[pair]
+    # carry forward the speed of the last anchor inside the trajectory.
+    anchor = is_first.copy()
+    anchor[pair] = True
+    index = np.maximum.accumulate(np.where(anchor, np.arange(n), 0))
+    return speed[index]
+
+
+def gen_speed(points: list, method='ellipsoid'):
     """
     calculate speed.
     :param points: trajectory points list.
+    :param method: see `distance`.
     """
-    if len(points) == 1:
-        points[0]['speed_cal'] = 0
-        return
-    for i in range(len(points) - 1):
-        first = points[i]
-        second = points[i + 1]
-        if first['time'] == second['time']:
-            if i == 0:
-                first['speed_cal'] = 0
-            else:
-                first['speed_cal'] = points[i - 1]['speed_cal']
-            continue
-        first['speed_cal'] = geodesic((second['y'], second['x']), (first['y'], first['x'])).m / (
-                second['time'] - first['time'])
-    front = points[len(points) - 2]
-    last = points[len(points) - 1]
-    if front['time'] == last['time']:
-        last['speed_cal'] = front['speed_cal']
-    else:
-        last['speed_cal'] = geodesic((last['y'], last['x']), (front['y'], front['x'])).m / (
-                last['time'] - front['time'])
+    speed = compute_speed([point['x'] for point in points], [point['y'] for point in points],
+                          [point['time'] for point in points], method=method)
+    for point, value in zip(points, speed.tolist()):
+        point['speed_cal'] = value
+
+
+def _segment_ranges(t, x, y, offsets, duration=120, minimum_point_size=10, max_distance=None,
+                    method='haversine') -> (np.ndarray, np.ndarray):
+    """
+    split trajectories to continuous parts in one pass.
+    :param t: time array.
+    :param x: longitude array, only used if max_distance is not None.
+    :param y: latitude array, only used if max_distance is not None.
+    :param offsets: the i-th trajectory is `[offsets[i], offsets[i + 1])`.
+    :param duration: see `segment_columns`.
+    :param minimum_point_size: see `segment_columns`.
+    :param max_distance: see `segment_columns`.
+    :param method: see `distance`.
+    :return: begins and ends of the continuous parts.
+    """
+    t = np.asarray(t)
+    n = len(t)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    is_begin = np.zeros(n, dtype=bool)
+    is_begin[offsets[:-1][offsets[:-1] < n]] = True
+    is_begin[1:] |= (t[1:] - t[:-1]) > duration
+    if max_distance is not None and n > 1:
+        is_begin[1:] |= distance(x[:-1], y[:-1], x[1:], y[1:], method) > max_distance
+    begins = np.flatnonzero(is_begin)
+    ends = np.append(begins[1:], n).astype(np.int64)
+    # a part never crosses the end of a trajectory, because every trajectory's first point is a begin.
+    keep = ends - begins >= minimum_point_size
+    begins, ends = begins[keep], ends[keep]
+    if metrics_util.enabled:
+        metrics_util.count('segments', len(begins))
+        metrics_util.count('points_segmented', int((ends - begins).sum()))
+        for length in (ends - begins).tolist():
+            metrics_util.observe('segment_length_points', length, metrics_util.LENGTH_BUCKETS)
+    return begins, ends
+
+
+@metrics_util.timed('segment')
+def segment_columns(columns: dict, duration=120, minimum_point_size=10, max_distance=None,
+                    method='haversine') -> np.ndarray:
+    """
+    split the trajectories of all cars to continuous parts in one pass. A part is split where the time gap is larger
+    than duration or the distance jump is larger than max_distance, and is discarded if it is too small.
+    :param columns: columns, see `import_columns`.
+    :param duration: maximum duration for continuous points.
+    :param minimum_point_size: The minimum points' size for a matching.
+    :param max_distance: maximum distance in meters between continuous points. If None, it is not checked.
+    :param method: see `distance`.
+    :return: an int64 array of shape (n, 3), each row is (car index, begin, end). The records of a part are
+    `columns[name][begin:end]`, see `get_segment`.
+    """
+    offsets = columns['offsets']
+    begins, ends = _segment_ranges(columns['time'], columns['longitude'], columns['latitude'], offsets,
+                                   duration, minimum_point_size, max_distance, method)
+    cars = np.searchsorted(offsets, begins, side='right') - 1
+    return np.column_stack((cars, begins, ends)).astype(np.int64).reshape(-1, 3)
+
+
+def get_segment(columns: dict, segment) -> dict:
+    """
+    get the records of a part without copying them.
+    :param columns: columns, see `import_columns`.
+    :param segment: a row of `segment_columns`.
+    :return: a dict, 'car_id' and the views of 'time', 'latitude', 'longitude' and 'speed'.
+    """
+    car, begin, end = (int(v) for v in segment)
+    res = {'car_id': str(columns['car_id'][car])}
+    for name in COLUMN_NAMES:
+        res[name] = columns[name][begin:end]
+    return res
 
 
-def preprocess_data(points: [{}], duration=120, minimum_point_size=10):
+def get_segment_points(columns: dict, segment) -> list:
+    """
+    get the records of a part as points list.
+    :param columns: columns, see `import_columns`.
+    :param segment: a row of `segment_columns`.
+    :return: trajectory points list.
+    """
+    view = get_segment(columns, segment)
+    values = [view[name].tolist() for name in COLUMN_NAMES]
+    return [{'car_id': view['car_id'], 'time': time, 'latitude': latitude, 'longitude': longitude, 'speed': speed}
+            for time, latitude, longitude, speed in zip(*values)]
+
+
+@metrics_util.timed('segment')
+def preprocess_data(points: [{}], duration=120, minimum_point_size=10, max_distance=None):
     """
     because the original trajectory may be discontinuous, this method split the whole trajectory points to many short
-    and continuous points list.
+    and continuous points list. Use `segment_columns` to split the trajectories of all cars without copying.
     :param points:  trajectory point list.
     :param duration:  maximum duration for continuous points.
     :param minimum_point_size: The minimum points' size for a matching.
+    :param max_distance: maximum distance in meters between continuous points. If None, it is not checked.
     :return a list of continuous points.
     """
     if len(points) < minimum_point_size:
         return []
-    times = [x['time'] for x in points]
-    times_np = np.array(times)
-    diff_times_np = times_np[1:] - times_np[:-1]
-    cut_index = np.where(diff_times_np > duration)
-    list_points = []
-    begin = 0
-    for end in cut_index[0]:
-        if end - begin > minimum_point_size:
-            list_points.append(points[begin: end])
-            begin = end + 1
-    return list_points
+    times = np.array([point['time'] for point in points])
+    x = y = None
+    if max_distance is not None:
+        x = np.array([point['longitude'] for point in points])
+        y = np.array([point['latitude'] for point in points])
+    begins, ends = _segment_ranges(times, x, y, [0, len(points)], duration, minimum_point_size, max_distance)
+    return [points[begin:end] for begin, end in zip(begins.tolist(), ends.tolist())]
+
+
+def _local_meters(x, y) -> (np.ndarray, np.ndarray):
+    """
+    project coordinates to a local plane in meters, it is accurate enough for a trajectory of some kilometers.
+    :param x: longitude array.
+    :param y: latitude array.
+    :return: x and y in meters.
+    """
+    x = np.radians(np.asarray(x, dtype=np.float64))
+    y = np.radians(np.asarray(y, dtype=np.float64))
+    return x * np.cos(np.mean(y)) * EARTH_RADIUS, y * EARTH_RADIUS
+
+
+def _douglas_peucker(px, py, t, keep, tolerance, time_aware, fixed=None):
+    """
+    Douglas-Peucker simplification of the points whose keep is True, the dropped points are set False in keep.
+    :param px: x array in meters.
+    :param py: y array in meters.
+    :param t: time array.
+    :param keep: the candidate points, it is modified in place.
+    :param tolerance: the maximum distance in meters from a dropped point to the simplified trajectory.
+    :param time_aware: if True, use the distance to the position interpolated by time (synchronized euclidean
+    distance), so the points where the speed changes are kept. Otherwise, use the distance to the line.
+    :param fixed: a bool array of the candidate points that are always kept. If None, only the first and last
+    candidates are.
+    """
+    index = np.flatnonzero(keep)
+    if len(index) < 3:
+        return
+    keep[index] = False
+    keep[index[0]] = keep[index[-1]] = True
+    pieces = [0, len(index) - 1] if fixed is None else \
+        np.union1d([0, len(index) - 1], np.flatnonzero(fixed[index])).tolist()
+    keep[index[pieces]] = True
+    stack = list(zip(pieces[:-1], pieces[1:]))
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b, inner = index[first], index[last], index[first + 1:last]
+        if time_aware and t[b] != t[a]:
+            ratio = (t[inner] - t[a]) / (t[b] - t[a])
+            dist = np.hypot(px[inner] - (px[a] + ratio * (px[b] - px[a])),
+                            py[inner] - (py[a] + ratio * (py[b] - py[a])))
+        else:
+            dx, dy = px[b] - px[a], py[b] - py[a]
+            norm = np.hypot(dx, dy)
+            if norm == 0:
+                dist = np.hypot(px[inner] - px[a], py[inner] - py[a])
+            else:
+                dist = np.abs(dx * (py[a] - py[inner]) - dy * (px[a] - px[inner])) / norm
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            middle = first + 1 + i
+            keep[index[middle]] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+
+
+def _stationary_points(px, py, radius) -> np.ndarray:
+    """
+    find the stationary runs of a trajectory. A run begins at a point and has the following points within radius of
+    it, so a slow but moving trajectory is not a run.
+    :param px: x array in meters.
+    :param py: y array in meters.
+    :param radius: the radius of a run in meters.
+    :return: a bool array, True for the points inside a run except its first and last points.
+    """
+    n = len(px)
+    inside = np.zeros(n, dtype=bool)
+    end = 0
+    # a run has at least a step shorter than radius from its first point.
+    for begin in np.flatnonzero(np.hypot(np.diff(px), np.diff(py)) <= radius).tolist():
+        if begin < end:
+            continue
+        end, window = begin + 1, 16
+        while end < n:
+            outside = np.hypot(px[end:end + window] - px[begin], py[end:end + window] - py[begin]) > radius
+            if outside.any():
+                end += int(np.argmax(outside))
+                break
+            end, window = end + window, window * 2
+        end = min(end, n)
+        inside[begin + 1:end - 1] = True
+        end -= 1
+    return inside
+
+
+def reduce_arrays(x, y, t, tolerance=5.0, stationary_radius=5.0, time_aware=True,
+                  max_interval=60) -> (np.ndarray, np.ndarray):
+    """
+    reduce the points of a trajectory before matching. The trajectory is simplified by Douglas-Peucker with tolerance,
+    so every dropped point is within tolerance of the reduced trajectory and a stationary run is collapsed to a few
+    points. A moving point is also kept every max_interval seconds, so the matcher does not have to search too long
+    paths between the kept points.
+    :param x: longitude array.
+    :param y: latitude array.
+    :param t: time array.
+    :param tolerance: the maximum distance in meters from a dropped point to the simplified trajectory.
+    :param stationary_radius: the radius in meters of a stationary run, see `_stationary_points`. The points inside a
+    run are not kept by max_interval.
+    :param time_aware: see `_douglas_peucker`.
+    :param max_interval: the seconds of the time bins, the first moving point of every bin is kept. If None, only
+    Douglas-Peucker decides.
+    :return: keep and mapping. keep is the indexes of the kept points. mapping[i] is the index in keep of the kept
+    point nearest in time to the i-th point, so `reduced_values[mapping]` projects the values computed on the reduced
+    trajectory (e.g. opath and speed) back onto every original point.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    n = len(t)
+    if n < 3:
+        return np.arange(n), np.arange(n)
+    px, py = _local_meters(x, y)
+    keep = np.ones(n, dtype=bool)
+    fixed = np.zeros(n, dtype=bool)
+    if max_interval is not None:
+        bins = t // max_interval
+        fixed[1:] = ~_stationary_points(px, py, stationary_radius)[1:] & (bins[1:] != bins[:-1])
+    # the points kept by max_interval split the trajectory, so the tolerance holds for the reduced trajectory.
+    _douglas_peucker(px, py, t, keep, tolerance, time_aware, fixed)
+    index = np.flatnonzero(keep)
+    # the kept point before or at every point, and the next one.
+    before = np.searchsorted(index, np.arange(n), side='right') - 1
+    after = np.minimum(before + 1, len(index) - 1)
+    mapping = np.where(t - t[index[before]] <= t[index[after]] - t, before, after)
+    return index, mapping
+
+
+def reduce_points(points: list, tolerance=5.0, stationary_radius=5.0, time_aware=True,
+                  max_interval=60) -> (list, np.ndarray):
+    """
+    reduce the points of a trajectory before matching. See `reduce_arrays`.
+    :param points: trajectory points list.
+    :param tolerance: see `reduce_arrays`.
+    :param stationary_radius: see `reduce_arrays`.
+    :param time_aware: see `reduce_arrays`.
+    :param max_interval: see `reduce_arrays`.
+    :return: the reduced points list(the same dicts as points) and the mapping.
+    """
+    keep, mapping = reduce_arrays([point['longitude'] for point in points], [point['latitude'] for point in points],
+                                  [point['time'] for point in points], tolerance, stationary_radius, time_aware,
+                                  max_interval)
+    return [points[i] for i in keep.tolist()], mapping
+
+
+def restore_points(points: list, reduced_points: list, mapping, keys=('opath', 'speed_cal')) -> list:
+    """
+    project the values computed on the reduced trajectory back onto every original point.
+    :param points: the original trajectory points list.
+    :param reduced_points: the reduced points list returned by `reduce_points`, after matching.
+    :param mapping: the mapping returned by `reduce_points`.
+    :param keys: the keys to be copied.
+    :return: the original points whose reduced point has all the keys, e.g. the matched points.
+    """
+    res = []
+    for point, i in zip(points, np.asarray(mapping).tolist()):
+        reduced = reduced_points[i]
+        if all(key in reduced for key in keys):
+            for key in keys:
+                point[key] = reduced[key]
+            res.append(point)
+    return res
+
+
+def _neighbor_speeds(x, y, t, index, segment, method):
+    """
+    the speeds from the previous point and to the next point of the same trajectory.
+    :param x: longitude array.
+    :param y: latitude array.
+    :param t: time array.
+    :param index: the indexes of the points in use, sorted.
+    :param segment: the trajectory number of every point.
+    :param method: see `distance`.
+    :return: speed_in and speed_out of the points in index, NaN if there is no previous or next point.
+    """
+    speed = np.full(max(len(index) - 1, 0), np.nan)
+    same = segment[index[1:]] == segment[index[:-1]]
+    a, b = index[:-1][same], index[1:][same]
+    with np.errstate(divide='ignore'):
+        speed[same] = distance(x[a], y[a], x[b], y[b], method) / (t[b] - t[a])
+    return np.concatenate(([np.nan], speed)), np.concatenate((speed, [np.nan]))
+
+
+def filter_outliers(x, y, t, offsets=None, max_speed=50.0, max_acceleration=10.0, method='haversine',
+                    baseline=5.0) -> (np.ndarray, dict):
+    """
+    remove the physically impossible points in one pass of every rule:
+    1. duplicate_time: a point with the same time as the previous point.
+    2. speed: a point whose speeds from the previous point and to the next point both exceed max_speed, i.e. a jump
+    and a return. Then the first or last point of a trajectory is removed if its speed to the next kept point exceeds
+    max_speed, so a jump next to it does not remove it.
+    3. acceleration: a point where the speed changes faster than max_acceleration. The speeds are measured from and to
+    the points baseline seconds away, so the GPS noise of a high sampling rate is not taken as acceleration.
+    :param x: longitude array.
+    :param y: latitude array.
+    :param t: time array, sorted in every trajectory.
+    :param offsets: the i-th trajectory is `[offsets[i], offsets[i + 1])`. If None, all points are one trajectory.
+    :param max_speed: m/s.
+    :param max_acceleration: m/s^2. If None, the acceleration rule is skipped.
+    :param method: see `distance`.
+    :param baseline: seconds.
+    :return: a boolean mask of the kept points and a dict of the number of removed points of every rule.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    n = len(t)
+    counts = {'duplicate_time': 0, 'speed': 0, 'acceleration': 0}
+    if n == 0:
+        return np.ones(0, dtype=bool), counts
+    if offsets is None:
+        offsets = np.array([0, n])
+    segment = np.repeat(np.arange(len(offsets) - 1), np.diff(np.asarray(offsets, dtype=np.int64)))
+    keep = np.ones(n, dtype=bool)
+    keep[1:] = ~((t[1:] == t[:-1]) & (segment[1:] == segment[:-1]))
+    counts['duplicate_time'] = int(n - keep.sum())
+    # the jumps inside the trajectories, then the first and last points with their next kept points.
+    index = np.flatnonzero(keep)
+    speed_in, speed_out = _neighbor_speeds(x, y, t, index, segment, method)
+    jump = (speed_in > max_speed) & (speed_out > max_speed)
+    keep[index[jump]] = False
+    index = np.flatnonzero(keep)
+    speed_in, speed_out = _neighbor_speeds(x, y, t, index, segment, method)
+    end = np.isnan(speed_in) != np.isnan(speed_out)
+    end_jump = end & ((speed_in > max_speed) | (speed_out > max_speed))
+    keep[index[end_jump]] = False
+    counts['speed'] = int(jump.sum() + end_jump.sum())
+    index = np.flatnonzero(keep)
+    # the speed rule may remove all the points.
+    if max_acceleration is not None and len(index) != 0:
+        kept_segment = segment[index]
+        first = np.searchsorted(kept_segment, kept_segment, side='left')
+        last = np.searchsorted(kept_segment, kept_segment, side='right') - 1
+        # the time since the first point of the trajectory, the trajectories are apart by more than baseline.
+        relative = t[index] - t[index[first]]
+        key = relative + kept_segment * (relative.max() + 2 * baseline + 1)
+        position = np.arange(len(index))
+        before = np.maximum(np.searchsorted(key, key - baseline, side='right') - 1, first)
+        after = np.minimum(np.searchsorted(key, key + baseline, side='left'), last)
+        valid = (before < position) & (after > position)
+        a, i, b = index[before[valid]], index[valid], index[after[valid]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            speed_in = distance(x[a], y[a], x[i], y[i], method) / (t[i] - t[a])
+            speed_out = distance(x[i], y[i], x[b], y[b], method) / (t[b] - t[i])
+            acceleration = (speed_out - speed_in) / ((t[b] - t[a]) / 2)
+        sudden = np.zeros(len(index), dtype=bool)
+        sudden[valid] = np.abs(acceleration) > max_acceleration
+        keep[index[sudden]] = False
+        counts['acceleration'] = int(sudden.sum())
+    for rule, value in counts.items():
+        metrics_util.count(f'outliers_{rule}', value)
+    return keep, counts
+
+
+def remove_outliers(points: list, max_speed=50.0, max_acceleration=10.0, baseline=5.0) -> (list, dict):
+    """
+    remove the physically impossible points of a trajectory. See `filter_outliers`.
+    :param points: trajectory points list, sorted by time.
+    :param max_speed: see `filter_outliers`.
+    :param max_acceleration: see `filter_outliers`.
+    :param baseline: see `filter_outliers`.
+    :return: the kept points and the number of removed points of every rule.
+    """
+    keep, counts = filter_outliers([point['longitude'] for point in points], [point['latitude'] for point in points],
+                                   [point['time'] for point in points], max_speed=max_speed,
+                                   max_acceleration=max_acceleration, baseline=baseline)
+    return [point for point, valid in zip(points, keep.tolist()) if valid], counts
@@ -9,14 +9,21 @@
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import networkx
+import numpy as np
 import osmnx as ox
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
 from shapely.geometry import Point
+from util import map_util
 
 
 def draw_map(G: networkx.MultiDiGraph, edge_color='gray', node_color='red', edge_linewidth=2, node_size=3):
     """
     draw a map. You can add the parameters of `ox.plot_graph` to draw a greater picture.
-    :param G: the map. You can use `map_util.download_map` to download it and use `map_util.load_map` to get it.
+    :param G: the map. You can use `map_util.download_map` to download it and use `map_util.load_map` to get it. It
+    can also be a map loaded by `map_util.load_graph_csr`, which is converted to networkx.MultiDiGraph here.
     :param edge_color: the edge color. You can specify a single color or get a dynamic color from a edge's attribute by
     `osmnx.plot.get_edge_colors_by_attr` method.
     :param node_color: the node color.
@@ -24,6 +31,8 @@ def draw_map(G: networkx.MultiDiGraph, edge_color='gray', node_color='red', edge
     :param node_size: the node size.
     :return: fig, ax
     """
+    if isinstance(G, dict):
+        G = map_util.csr_to_graph(G)
     fig, ax = ox.plot_graph(G, edge_color=edge_color, node_color=node_color, edge_linewidth=edge_linewidth,
                             node_size=node_size, show=False)
     ax.get_xaxis().set_visible(True)
@@ -70,3 +79,141 @@ def draw_point(points, ax, color, alpha, markersize):
         return
     _convert_gdf(points).plot(ax=ax, color=color, alpha=alpha, markersize=markersize)
     plt.show()
+
+
+def density_raster(x, y, bins=1024, extent=None, weights=None) -> (np.ndarray, tuple):
+    """
+    count the points in the cells of a raster.
+    :param x: longitude array.
+    :param y: latitude array.
+    :param bins: the number of cells in x and y, or (x bins, y bins).
+    :param extent: (min x, max x, min y, max y). If None, it is the bounds of points.
+    :param weights: if not None, the sum of weights of the points in every cell.
+    :return: the raster of shape (y bins, x bins), the first row is the lowest y, and the extent.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if extent is None:
+        extent = (x.min(), x.max(), y.min(), y.max()) if len(x) != 0 else (0.0, 1.0, 0.0, 1.0)
+    raster, _, _ = np.histogram2d(x, y, bins=bins, range=((extent[0], extent[1]), (extent[2], extent[3])),
+                                  weights=weights)
+    return raster.T, tuple(extent)
+
+
+def edge_segments(geom_x, geom_y, geom_offsets) -> (np.ndarray, np.ndarray):
+    """
+    split the edge geometries to line segments.
+    :param geom_x: x of all the edge points, see `map_util.save_graph_csr`.
+    :param geom_y: y of all the edge points.
+    :param geom_offsets: the points of the i-th edge are `[geom_offsets[i], geom_offsets[i + 1])`.
+    :return: an array of shape (n, 2, 2) of the segments, and the edge index of every segment.
+    """
+    geom_x = np.asarray(geom_x, dtype=np.float64)
+    geom_y = np.asarray(geom_y, dtype=np.float64)
+    geom_offsets = np.asarray(geom_offsets, dtype=np.int64)
+    is_last = np.zeros(len(geom_x), dtype=bool)
+    is_last[geom_offsets[1:][geom_offsets[1:] > 0] - 1] = True
+    begin = np.flatnonzero(~is_last[:-1]) if len(geom_x) > 1 else np.zeros(0, dtype=np.int64)
+    segments = np.stack((np.column_stack((geom_x[begin], geom_y[begin])),
+                         np.column_stack((geom_x[begin + 1], geom_y[begin + 1]))), axis=1)
+    return segments, np.searchsorted(geom_offsets, begin, side='right') - 1
+
+
+def draw_edges(ax, csr: dict, values=None, color='gray', cmap='viridis', linewidth=0.5, vmin=None, vmax=None):
+    """
+    draw the edges of a map as one line collection.
+    :param ax: fig ax.
+    :param csr: a map loaded by `map_util.load_graph_csr`, or a dict of 'geom_x', 'geom_y' and 'geom_offsets'.
+    :param values: if not None, a value of every edge (e.g. the median speed, map the edge ids by
+    csr['edge_osmid']), the edges are colored by cmap. The edges whose value is NaN are drawn in color.
+    :param color: the edge color.
+    :param cmap: see above.
+    :param linewidth: the edge line width.
+    :param vmin: the value of the lowest color. If None, it is the minimum value.
+    :param vmax: the value of the highest color. If None, it is the maximum value.
+    :return: the LineCollection of the colored edges, or of all the edges if values is None.
+    """
+    segments, edge = edge_segments(csr['geom_x'], csr['geom_y'], csr['geom_offsets'])
+    if values is None:
+        collection = LineCollection(segments, colors=color, linewidths=linewidth)
+        ax.add_collection(collection)
+    else:
+        value = np.asarray(values, dtype=np.float64)[edge]
+        valid = ~np.isnan(value)
+        if not valid.all():
+            ax.add_collection(LineCollection(segments[~valid], colors=color, linewidths=linewidth))
+        collection = LineCollection(segments[valid], cmap=cmap, linewidths=linewidth)
+        collection.set_array(value[valid])
+        collection.set_clim(vmin, vmax)
+        ax.add_collection(collection)
+    if len(segments) != 0:
+        ax.update_datalim(segments.reshape(-1, 2))
+        ax.autoscale_view()
+    return collection
+
+
+def draw_density(ax, x, y, bins=1024, extent=None, cmap='magma', log=True, alpha=1.0):
+    """
+    draw the density raster of points. It is fast for any number of points, use it instead of `draw_point` for
+    large data.
+    :param ax: fig ax.
+    :param x: longitude array.
+    :param y: latitude array.
+    :param bins: see `density_raster`.
+    :param extent: see `density_raster`.
+    :param cmap: color map.
+    :param log: if True, the colors are in log scale of the counts.
+    :param alpha: alpha.
+    :return: AxesImage
+    """
+    raster, extent = density_raster(x, y, bins, extent)
+    raster = np.where(raster > 0, raster, np.nan)
+    norm = LogNorm(vmin=1, vmax=max(np.nanmax(raster), 1) if not np.isnan(raster).all() else 1) if log else None
+    return ax.imshow(raster, extent=extent, origin='lower', cmap=cmap, norm=norm, alpha=alpha,
+                     interpolation='nearest', aspect='auto')
+
+
+def render_png(file_path: str, csr: dict = None, x=None, y=None, values=None, bins=1024, extent=None,
+               figsize=(10, 10), dpi=150, title: str = None, edge_color='gray', edge_cmap='viridis',
+               point_cmap='magma', linewidth=0.5, colorbar_label: str = None):
+    """
+    render the edges of a map and the density of points to a png file without a display, it can be used in batch
+    jobs. The figure does not use pyplot, so nothing is shown and the figure is freed after return.
+    :param file_path: png file path.
+    :param csr: if not None, the map is drawn, see `draw_edges`.
+    :param x: if not None, the longitude array of points whose density is drawn.
+    :param y: latitude array of points.
+    :param values: see `draw_edges`.
+    :param bins: see `density_raster`.
+    :param extent: see `density_raster`. If None and csr is not None, it is the bounds of the map.
+    :param figsize: figure size, inch.
+    :param dpi: dpi.
+    :param title: title.
+    :param edge_color: see `draw_edges`.
+    :param edge_cmap: see `draw_edges`.
+    :param point_cmap: see `draw_density`.
+    :param linewidth: see `draw_edges`.
+    :param colorbar_label: if not None and values is not None, a colorbar of the edge values is drawn.
+    :return: file_path
+    """
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    if extent is None and csr is not None and len(csr['geom_x']) != 0:
+        extent = (float(np.min(csr['geom_x'])), float(np.max(csr['geom_x'])), float(np.min(csr['geom_y'])),
+                  float(np.max(csr['geom_y'])))
+    if x is not None:
+        draw_density(ax, x, y, bins, extent, point_cmap)
+    if csr is not None:
+        collection = draw_edges(ax, csr, values, edge_color, edge_cmap, linewidth)
+        if values is not None and colorbar_label is not None:
+            fig.colorbar(collection, ax=ax, label=colorbar_label)
+    if extent is not None:
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[2], extent[3])
+    ax.set_xlabel('longitude')
+    ax.set_ylabel('latitude')
+    if title is not None:
+        ax.set_title(title)
+    fig.savefig(file_path)
+    return file_path
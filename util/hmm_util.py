@@ -0,0 +1,355 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   hmm_util.py
+@Modify Time :   2023/3/2 10:15
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   a pure python hidden markov model map matching engine, it is an alternative of fmm.
+'''
+import heapq
+
+import numpy as np
+import shapely
+from shapely.geometry import LineString, Point
+from shapely.ops import substring
+
+
+class HMMMatchConfig:
+    """
+    The match config of `HMMMatcher`, it has the same parameters as fmm FastMapMatchConfig. All the distances are in
+    the unit of the network: the maps of `map_util.download_map` are in degree, so radius and gps_error should be
+    about 0.003 and 0.0005 (300 and 50 meters), the defaults are for a projected network in meters.
+    """
+
+    def __init__(self, k=8, radius=100, gps_error=50):
+        """
+        :param k: number of candidates.
+        :param radius: search radius, in the unit of the network.
+        :param gps_error: GPS error, in the unit of the network.
+        """
+        self.k = k
+        self.radius = radius
+        self.gps_error = gps_error
+
+
+class HMMMatcher:
+    """
+    A map matching engine. The candidates of each point are searched by a STRtree of edges, the emission and
+    transition probabilities are computed by numpy for every pair of layers, and the optimal path is decoded by
+    Viterbi. The shortest path between edges is searched by Dijkstra bounded by delta and cached by source node.
+    """
+
+    def __init__(self, edge_id, source, target, geoms: list, delta=0.03, cache_size=100000):
+        """
+        :param edge_id: edge id array.
+        :param source: edge source node array.
+        :param target: edge target node array.
+        :param geoms: edge geometries, a list of shapely LineString.
+        :param delta: the upper bound of the shortest path between two candidates, in the unit of the network. It is
+        the same as the delta of fmm UBODT.
+        :param cache_size: the maximum number of source nodes whose shortest paths are cached.
+        """
+        self.edge_id = np.asarray(edge_id, dtype=np.int64)
+        self.geoms = np.array(geoms, dtype=object)
+        self.lengths = shapely.length(self.geoms)
+        self.delta = delta
+        self.cache_size = cache_size
+        self.tree = shapely.STRtree(self.geoms)
+        # the first radius of the candidate search, see `_search_candidates`.
+        self.search_radius = float(np.median(self.lengths)) if len(self.lengths) != 0 else 0.0
+        nodes, index = np.unique(np.concatenate((np.asarray(source), np.asarray(target))), return_inverse=True)
+        self.source = index[:len(self.edge_id)]
+        self.target = index[len(self.edge_id):]
+        # CSR adjacency: the outgoing edges of node i are out_edge[indptr[i]:indptr[i + 1]].
+        self.out_edge = np.argsort(self.source, kind='stable')
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(self.source, minlength=len(nodes)))))
+        self._cache = {}
+
+    @classmethod
+    def from_shapefile(cls, file_path: str, id='fid', source='u', target='v', delta=0.03):
+        """
+        build the engine from the edge shape file saved by `map_util.download_map`.
+        :param file_path: edge shape file path.
+        :param id: edge shape attribute, edge id.
+        :param source: edge shape attribute, edge source.
+        :param target: edge shape attribute, edge target.
+        :param delta: see `HMMMatcher`.
+        :return: HMMMatcher
+        """
+        import geopandas as gpd
+        gdf = gpd.read_file(file_path)
+        return cls(gdf[id].to_numpy(), gdf[source].to_numpy(), gdf[target].to_numpy(), list(gdf.geometry), delta)
+
+    @classmethod
+    def from_graph(cls, G, delta=0.03):
+        """
+        build the engine from the map saved by `map_util.download_map`, the edge id is the 'osmid' attribute.
+        :param G: networkx.MultiDiGraph.
+        :param delta: see `HMMMatcher`.
+        :return: HMMMatcher
+        """
+        edge_id, source, target, geoms = [], [], [], []
+        for u, v, data in G.edges(data=True):
+            edge_id.append(data['osmid'])
+            source.append(u)
+            target.append(v)
+            if 'geometry' in data:
+                geoms.append(data['geometry'])
+            else:
+                geoms.append(LineString([(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])]))
+        return cls(edge_id, source, target, geoms, delta)
+
+    @classmethod
+    def from_csr(cls, csr: dict, delta=0.03):
+        """
+        build the engine from the map loaded by `map_util.load_graph_csr`, the edge id is the 'osmid' attribute.
+        :param csr: the map.
+        :param delta: see `HMMMatcher`.
+        :return: HMMMatcher
+        """
+        offsets = csr['geom_offsets']
+        geoms = [LineString(np.column_stack((csr['geom_x'][begin:end], csr['geom_y'][begin:end])))
+                 for begin, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+        return cls(csr['edge_osmid'], csr['edge_source'], csr['edge_target'], geoms, delta)
+
+    def _search_candidates(self, x, y, config: HMMMatchConfig) -> dict:
+        """
+        search at most k candidate edges within radius for every point. The search begins with the median edge length
+        and doubles the radius for the points with less than k candidates, so a large radius does not give every point
+        all the edges within it.
+        :param x: x array.
+        :param y: y array.
+        :param config: match config.
+        :return: a dict of (n, k) arrays, 'edge' is the edge index(-1 if there is no candidate), 'offset' is the
+        distance from the edge's source along the edge, 'distance' is the distance from the point to the edge.
+        """
+        n = len(x)
+        points = shapely.points(x, y)
+        found_point, found_edge = [], []
+        pending = np.arange(n)
+        radius = min(self.search_radius, config.radius) if self.search_radius > 0 else config.radius
+        while len(pending) != 0:
+            point_index, edge_index = self.tree.query(points[pending], predicate='dwithin', distance=radius)
+            # the k nearest edges of a point with k edges within radius are all within radius.
+            done = (np.bincount(point_index, minlength=len(pending)) >= config.k) | (radius >= config.radius)
+            found = done[point_index]
+            found_point.append(pending[point_index[found]])
+            found_edge.append(edge_index[found])
+            pending = pending[~done]
+            radius = min(radius * 2, config.radius)
+        point_index = np.concatenate(found_point) if len(found_point) != 0 else np.zeros(0, dtype=np.int64)
+        edge_index = np.concatenate(found_edge) if len(found_edge) != 0 else np.zeros(0, dtype=np.int64)
+        dist = shapely.distance(points[point_index], self.geoms[edge_index])
+        order = np.lexsort((dist, point_index))
+        point_index, edge_index, dist = point_index[order], edge_index[order], dist[order]
+        # the rank of each candidate among the candidates of its point.
+        first = np.searchsorted(point_index, point_index, side='left')
+        rank = np.arange(len(point_index)) - first
+        keep = rank < config.k
+        point_index, edge_index, dist, rank = point_index[keep], edge_index[keep], dist[keep], rank[keep]
+        res = {'edge': np.full((n, config.k), -1, dtype=np.int64),
+               'offset': np.zeros((n, config.k)),
+               'distance': np.full((n, config.k), np.inf)}
+        res['edge'][point_index, rank] = edge_index
+        res['distance'][point_index, rank] = dist
+        res['offset'][point_index, rank] = shapely.line_locate_point(self.geoms[edge_index], points[point_index])
+        return res
+
+    def _shortest_paths(self, node: int) -> (dict, dict):
+        """
+        Dijkstra from node, bounded by delta.
+        :param node: source node index.
+        :return: distance dict and predecessor edge dict of the reached nodes.
+        """
+        if node in self._cache:
+            return self._cache[node]
+        dist = {node: 0.0}
+        pred = {}
+        heap = [(0.0, node)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for e in self.out_edge[self.indptr[u]:self.indptr[u + 1]].tolist():
+                v = int(self.target[e])
+                nd = d + self.lengths[e]
+                if nd <= self.delta and nd < dist.get(v, np.inf):
+                    dist[v] = nd
+                    pred[v] = e
+                    heapq.heappush(heap, (nd, v))
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[node] = (dist, pred)
+        return dist, pred
+
+    def _path_edges(self, source_node: int, target_node: int) -> list:
+        """
+        :param source_node: source node index.
+        :param target_node: target node index, it must be reached from source_node.
+        :return: the edge indexes of the shortest path.
+        """
+        _, pred = self._shortest_paths(source_node)
+        edges = []
+        node = target_node
+        while node != source_node:
+            e = pred[node]
+            edges.append(e)
+            node = int(self.source[e])
+        return edges[::-1]
+
+    def _transition_distance(self, edge_a, offset_a, edge_b, offset_b) -> np.ndarray:
+        """
+        the shortest path distances between the candidates of two layers.
+        :param edge_a: edge indexes of the first layer.
+        :param offset_a: offsets of the first layer.
+        :param edge_b: edge indexes of the second layer.
+        :param offset_b: offsets of the second layer.
+        :return: (len(edge_a), len(edge_b)) array, inf if unreachable.
+        """
+        res = np.full((len(edge_a), len(edge_b)), np.inf)
+        source_b = self.source[edge_b]
+        for i, (e, offset) in enumerate(zip(edge_a.tolist(), offset_a.tolist())):
+            dist, _ = self._shortest_paths(int(self.target[e]))
+            node_dist = np.array([dist.get(int(v), np.inf) for v in source_b.tolist()])
+            res[i] = self.lengths[e] - offset + node_dist + offset_b
+            same = (edge_b == e) & (offset_b >= offset)
+            res[i, same] = offset_b[same] - offset
+        return res
+
+    def _viterbi(self, x, y, config: HMMMatchConfig, stop_at_break: bool) -> (list, dict, list):
+        """
+        decode the optimal candidates. When no candidate of a layer can be reached, the trajectory breaks there and
+        the decoding restarts from the next point.
+        :param x: x array.
+        :param y: y array.
+        :param config: match config.
+        :param stop_at_break: if True, stop at the first break.
+        :return: a list of (begin, end) of continuous parts, the candidates and the chosen candidate of each point.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        n = len(x)
+        candidates = self._search_candidates(x, y, config)
+        emission = -0.5 * (candidates['distance'] / config.gps_error) ** 2
+        back = np.zeros((n, config.k), dtype=np.int64)
+        chosen = np.full(n, -1, dtype=np.int64)
+        ranges = []
+        begin = 0
+        score = emission[0] if n != 0 else None
+        for i in range(1, n + 1):
+            broken = i == n
+            if not broken:
+                valid_a = np.flatnonzero(np.isfinite(score))
+                valid_b = np.flatnonzero(candidates['edge'][i] >= 0)
+                new_score = np.full(config.k, -np.inf)
+                if len(valid_a) != 0 and len(valid_b) != 0:
+                    sp = self._transition_distance(candidates['edge'][i - 1][valid_a],
+                                                   candidates['offset'][i - 1][valid_a],
+                                                   candidates['edge'][i][valid_b], candidates['offset'][i][valid_b])
+                    eu = np.hypot(x[i] - x[i - 1], y[i] - y[i - 1])
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        ratio = np.where(np.maximum(sp, eu) > 0, np.minimum(sp, eu) / np.maximum(sp, eu), 1.0)
+                        total = score[valid_a][:, None] + np.log(ratio) + emission[i][valid_b][None, :]
+                    best = np.argmax(total, axis=0)
+                    new_score[valid_b] = total[best, np.arange(len(valid_b))]
+                    back[i, valid_b] = valid_a[best]
+                broken = not np.isfinite(new_score).any()
+            if broken:
+                if np.isfinite(score).any():
+                    # backtrack the part [begin, i)
+                    c = int(np.argmax(score))
+                    for j in range(i - 1, begin - 1, -1):
+                        chosen[j] = c
+                        c = back[j, c]
+                ranges.append((begin, i))
+                if stop_at_break or i == n:
+                    break
+                begin = i
+                score = emission[i]
+            else:
+                score = new_score
+        return ranges, candidates, chosen
+
+    def check_match(self, x, y, config: HMMMatchConfig) -> int:
+        """
+        find the first break of a trajectory, the same as fmm check_match_wkt.
+        :param x: x array.
+        :param y: y array.
+        :param config: match config.
+        :return: the index of the last point before the first break, -1 if the trajectory can be matched.
+        """
+        ranges, _, _ = self._viterbi(x, y, config, True)
+        if len(ranges) == 0 or ranges[0][1] == len(x):
+            return -1
+        return ranges[0][1] - 1
+
+    def split(self, x, y, config: HMMMatchConfig) -> list:
+        """
+        find the ranges of the continuous parts of a trajectory in one pass.
+        :param x: x array.
+        :param y: y array.
+        :param config: match config.
+        :return: a list of (begin, end).
+        """
+        ranges, _, _ = self._viterbi(x, y, config, False)
+        return ranges
+
+    def _build_result(self, candidates: dict, chosen: np.ndarray, begin: int, end: int) -> dict:
+        """
+        build the match result of a continuous part from the decoded candidates.
+        :param candidates: see `_search_candidates`.
+        :param chosen: the chosen candidate of each point, see `_viterbi`.
+        :param begin: the first point of the part.
+        :param end: the end of the part, exclusive.
+        :return: see `match`.
+        """
+        chosen = chosen[begin:end]
+        if len(chosen) == 0 or (chosen < 0).any():
+            return {'opath': np.zeros(0, dtype=np.int64), 'cpath': np.zeros(0, dtype=np.int64),
+                    'mgeom_x': np.zeros(0), 'mgeom_y': np.zeros(0)}
+        rows = np.arange(begin, end)
+        edges = candidates['edge'][rows, chosen]
+        offsets = candidates['offset'][rows, chosen]
+        cpath = [int(edges[0])]
+        # the offset where the matched geometry begins on each edge of cpath.
+        for i in range(1, len(edges)):
+            e_a, e_b = int(edges[i - 1]), int(edges[i])
+            if e_a == e_b and offsets[i] >= offsets[i - 1]:
+                continue
+            cpath += self._path_edges(int(self.target[e_a]), int(self.source[e_b])) + [e_b]
+        coords = []
+        for j, e in enumerate(cpath):
+            begin = offsets[0] if j == 0 else 0
+            end = offsets[-1] if j == len(cpath) - 1 else self.lengths[e]
+            part = substring(self.geoms[e], begin, end)
+            part_coords = list(part.coords) if not isinstance(part, Point) else [part.coords[0]]
+            coords += part_coords if len(coords) == 0 else part_coords[1:]
+        coords = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        return {'opath': self.edge_id[edges], 'cpath': self.edge_id[np.array(cpath, dtype=np.int64)],
+                'mgeom_x': coords[:, 0].copy(), 'mgeom_y': coords[:, 1].copy()}
+
+    def match(self, x, y, config: HMMMatchConfig) -> dict:
+        """
+        match a continuous trajectory.
+        :param x: x array.
+        :param y: y array.
+        :param config: match config.
+        :return: a dict of numpy arrays, 'opath', 'cpath', 'mgeom_x' and 'mgeom_y', the same as `match_util._match`.
+        The arrays are empty if the trajectory can not be matched.
+        """
+        ranges, candidates, chosen = self._viterbi(x, y, config, True)
+        if len(ranges) != 1:
+            chosen = np.full(len(x), -1, dtype=np.int64)
+        return self._build_result(candidates, chosen, 0, len(x))
+
+    def match_all(self, x, y, config: HMMMatchConfig) -> (list, list):
+        """
+        split a trajectory to continuous parts and match every part, with one candidate search and one decoding.
+        :param x: x array.
+        :param y: y array.
+        :param config: match config.
+        :return: a list of (begin, end) of the parts, see `split`, and a list of the results of the parts, see
+        `match`.
+        """
+        ranges, candidates, chosen = self._viterbi(x, y, config, False)
+        return ranges, [self._build_result(candidates, chosen, begin, end) for begin, end in ranges]
@@ -0,0 +1,245 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   io_util.py
+@Modify Time :   2023/3/10 11:05
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   write matched results to columnar files
+'''
+import os
+import zlib
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is optional, the results can be written as npz.
+    pa = None
+    pq = None
+
+POINT_COLUMNS = ('car_id', 'time', 'x', 'y', 'opath', 'speed')
+GEOMETRY_COLUMNS = ('segment_id', 'car_id', 'time_begin', 'time_end', 'x', 'y')
+
+
+class ResultWriter:
+    """
+    A writer of matched points and repaired trajectories. The rows are buffered by partition and every row_group_size
+    rows of a partition are written as a row group, so the results are persisted while they are produced. A parquet
+    file is kept open for every partition and gets a row group per write, it is complete after `close`. A npz file
+    is written for every write. The buffers of the time bins before the previous bin of the newest time are written
+    and their files are closed, and at most max_buffered_rows rows are buffered. The files are partitioned by time
+    and car:
+    `directory/points/time_bin=<begin time of bin>/car_bucket=<bucket>/part-<n>.parquet` and
+    `directory/geometries/time_bin=<begin time of bin>/car_bucket=<bucket>/part-<n>.parquet`.
+    A geometry row is a repaired trajectory, its x and y are lists.
+    """
+
+    def __init__(self, directory: str, file_format='parquet', row_group_size=100000, time_bin=3600, car_buckets=16,
+                 max_buffered_rows=1000000):
+        """
+        :param directory: the directory of the result files.
+        :param file_format: 'parquet'(needs pyarrow) or 'npz'.
+        :param row_group_size: the number of rows of a partition that are written together.
+        :param time_bin: the seconds of a time partition.
+        :param car_buckets: the number of car partitions, a car is put to the bucket crc32(car_id) % car_buckets.
+        :param max_buffered_rows: the maximum number of buffered rows of all the partitions, the largest buffers are
+        written first when it is exceeded.
+        """
+        if file_format == 'parquet' and pa is None:
+            raise Exception('pyarrow is not installed, use the npz format.')
+        if file_format not in ('parquet', 'npz'):
+            raise Exception(f'unknown file format: {file_format}.')
+        self.directory = directory
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.time_bin = time_bin
+        self.car_buckets = car_buckets
+        self.max_buffered_rows = max_buffered_rows
+        self.segment_id = 0
+        self.file_number = 0
+        # (table, time bin, bucket) -> {'rows': number of rows, 'columns': {name: list of arrays}}
+        self._buffers = {}
+        self._buffered_rows = 0
+        self._newest_bin = None
+        # (table, time bin, bucket) -> the open pq.ParquetWriter
+        self._writers = {}
+
+    def _partition(self, car_id: str, time) -> (int, int):
+        """
+        :param car_id: car id.
+        :param time: time.
+        :return: the begin time of the time bin and the car bucket.
+        """
+        return int(time) // self.time_bin * self.time_bin, zlib.crc32(str(car_id).encode('utf-8')) % self.car_buckets
+
+    def _append(self, table: str, partition: tuple, columns: dict, rows: int):
+        """
+        buffer some rows of a partition and write them if there are enough rows.
+        :param table: 'points' or 'geometries'.
+        :param partition: (time bin, bucket).
+        :param columns: a dict of column name to values.
+        :param rows: the number of rows.
+        """
+        key = (table,) + partition
+        buffer = self._buffers.setdefault(key, {'rows': 0, 'columns': {name: [] for name in columns}})
+        for name, values in columns.items():
+            buffer['columns'][name].append(values)
+        buffer['rows'] += rows
+        self._buffered_rows += rows
+        if buffer['rows'] >= self.row_group_size:
+            self._flush(key)
+        if self._newest_bin is None or partition[0] > self._newest_bin:
+            self._newest_bin = partition[0]
+            # the segments are short, so the bins before the previous bin are finished.
+            for old_key in [old_key for old_key in set(self._buffers) | set(self._writers)
+                            if old_key[1] < self._newest_bin - self.time_bin]:
+                self._flush(old_key)
+                self._close_writer(old_key)
+        if self._buffered_rows > self.max_buffered_rows:
+            for old_key in sorted(self._buffers, key=lambda k: -self._buffers[k]['rows']):
+                self._flush(old_key)
+                if self._buffered_rows <= self.max_buffered_rows // 2:
+                    break
+
+    def _file_path(self, key: tuple) -> str:
+        """
+        :param key: (table, time bin, bucket).
+        :return: the path of a new file of the partition.
+        """
+        table, time_bin, bucket = key
+        path = os.path.join(self.directory, table, f'time_bin={time_bin}', f'car_bucket={bucket}')
+        os.makedirs(path, exist_ok=True)
+        self.file_number += 1
+        return os.path.join(path, f'part-{os.getpid()}-{self.file_number - 1:06d}.{self.file_format}')
+
+    def _close_writer(self, key: tuple):
+        """
+        close the parquet file of a partition, the next rows of the partition are written to a new file.
+        :param key: (table, time bin, bucket).
+        """
+        writer = self._writers.pop(key, None)
+        if writer is not None:
+            writer.close()
+
+    def _flush(self, key: tuple):
+        """
+        write the buffered rows of a partition, to a new npz file or as a row group of the parquet file.
+        :param key: (table, time bin, bucket).
+        """
+        buffer = self._buffers.pop(key, None)
+        if buffer is None or buffer['rows'] == 0:
+            return
+        self._buffered_rows -= buffer['rows']
+        table = key[0]
+        columns = buffer['columns']
+        if table == 'points':
+            data = {name: np.concatenate(columns[name]) for name in POINT_COLUMNS}
+        else:
+            data = {name: np.concatenate(columns[name]) for name in GEOMETRY_COLUMNS[:4]}
+            lengths = np.array([len(x) for x in columns['x']], dtype=np.int64)
+            data['offsets'] = np.concatenate(([0], np.cumsum(lengths)))
+            data['x'] = np.concatenate(columns['x']) if len(lengths) != 0 else np.zeros(0)
+            data['y'] = np.concatenate(columns['y']) if len(lengths) != 0 else np.zeros(0)
+        if self.file_format == 'npz':
+            np.savez(self._file_path(key), **data)
+            return
+        if table == 'geometries':
+            offsets = pa.array(data.pop('offsets'), type=pa.int32())
+            data['x'] = pa.ListArray.from_arrays(offsets, pa.array(data['x']))
+            data['y'] = pa.ListArray.from_arrays(offsets, pa.array(data['y']))
+        data = pa.table(data)
+        if key not in self._writers:
+            self._writers[key] = pq.ParquetWriter(self._file_path(key), data.schema)
+        self._writers[key].write_table(data, row_group_size=self.row_group_size)
+
+    def write_columns(self, car_id, time, x, y, opath, speed):
+        """
+        write matched points given as arrays.
+        :param car_id: car id array, or a car id of all the points.
+        :param time: time array.
+        :param x: longitude array.
+        :param y: latitude array.
+        :param opath: the matched edge id array.
+        :param speed: the speed array.
+        """
+        time = np.asarray(time, dtype=np.int64)
+        n = len(time)
+        if n == 0:
+            return
+        car_id = np.asarray(car_id, dtype=str)
+        if car_id.ndim == 0:
+            car_id = np.full(n, car_id)
+        columns = {'car_id': car_id, 'time': time, 'x': np.asarray(x, dtype=np.float64),
+                   'y': np.asarray(y, dtype=np.float64), 'opath': np.asarray(opath, dtype=np.int64),
+                   'speed': np.asarray(speed, dtype=np.float64)}
+        bins = time // self.time_bin * self.time_bin
+        cars, car_index = np.unique(car_id, return_inverse=True)
+        buckets = np.array([self._partition(c, 0)[1] for c in cars.tolist()], dtype=np.int64)[car_index.reshape(-1)]
+        keys = np.stack((bins, buckets), axis=1)
+        partitions, inverse = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(inverse.reshape(-1), kind='stable')
+        bounds = np.cumsum(np.bincount(inverse.reshape(-1), minlength=len(partitions)))
+        for (time_bin, bucket), index in zip(partitions.tolist(), np.split(order, bounds[:-1])):
+            self._append('points', (time_bin, bucket), {name: values[index] for name, values in columns.items()},
+                         len(index))
+
+    def write_points(self, points_with_opath: list):
+        """
+        write matched points.
+        :param points_with_opath: the points list returned by `match_util.match_points`.
+        """
+        if len(points_with_opath) == 0:
+            return
+        self.write_columns([point.get('car_id', '') for point in points_with_opath],
+                           [point['time'] for point in points_with_opath],
+                           [point['longitude'] for point in points_with_opath],
+                           [point['latitude'] for point in points_with_opath],
+                           [point['opath'] for point in points_with_opath],
+                           [point.get('speed_cal', np.nan) for point in points_with_opath])
+
+    def write_geometry(self, car_id: str, time_begin: int, time_end: int, x, y):
+        """
+        write a repaired trajectory.
+        :param car_id: car id.
+        :param time_begin: the time of the first point of the trajectory.
+        :param time_end: the time of the last point of the trajectory.
+        :param x: longitude array.
+        :param y: latitude array.
+        """
+        columns = {'segment_id': np.array([self.segment_id], dtype=np.int64), 'car_id': np.array([car_id], dtype=str),
+                   'time_begin': np.array([time_begin], dtype=np.int64),
+                   'time_end': np.array([time_end], dtype=np.int64),
+                   'x': np.asarray(x, dtype=np.float64), 'y': np.asarray(y, dtype=np.float64)}
+        self.segment_id += 1
+        self._append('geometries', self._partition(car_id, time_begin), columns, 1)
+
+    def write_match(self, points_with_opath: list, fix_trajectory: list, error: str = None):
+        """
+        write the result of a segment, it can be the sink of `pipeline_util.match_files`.
+        :param points_with_opath: see `match_util.match_points`.
+        :param fix_trajectory: see `match_util.match_points`.
+        :param error: the match error, nothing is written if it is not None.
+        """
+        if error is not None or len(points_with_opath) == 0:
+            return
+        self.write_points(points_with_opath)
+        self.write_geometry(points_with_opath[0].get('car_id', ''), points_with_opath[0]['time'],
+                            points_with_opath[-1]['time'], [point['x'] for point in fix_trajectory],
+                            [point['y'] for point in fix_trajectory])
+
+    def close(self):
+        """
+        write all the buffered rows and close the files.
+        """
+        for key in list(self._buffers):
+            self._flush(key)
+        for key in list(self._writers):
+            self._close_writer(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -7,11 +7,20 @@
 @Desciption  :   download map
 '''
 
+import hashlib
+import inspect
+import json
+import multiprocessing
 import os
 import pickle
 
+import numpy as np
 import osmnx as ox
 import networkx
+import shapely
+from shapely.geometry import LineString
+
+from util import data_util, metrics_util
 
 
 def _save_graph_shapefile_directional(G, filepath, edges_name, nodes_name, encoding="utf-8"):
@@ -60,11 +69,12 @@ def _save_graph_osm(G, filepath, graph_name, dropEdge):
     f.close()
 
 
+@metrics_util.timed('map_download')
 def download_map(polygon, file_directory: str, edges_name: str, nodes_name: str, origin_graph_name: str,
                  graph_name: str,
                  simplify=True, custom_filter='["highway"~"motorway|trunk|primary|secondary|tertiary"]',
                  way_type='drive',
-                 consolidate=True, tolerance=48, dropEdge=True):
+                 consolidate=True, tolerance=48, dropEdge=True, csr_name: str = None):
     """
     Download a map from OSM and SHP within the boundaries of some shapely polygon. This method provides some parameters
     for custom maps. However, due to too many parameters, you can see `osmnx.graph_from_polygon`, `osmnx.simplify_graph`
@@ -82,6 +92,7 @@ def download_map(polygon, file_directory: str, edges_name: str, nodes_name: str,
     :param consolidate: if True, call the `osmnx.consolidate_intersections` method.
     :param dropEdge: if True, remove the edge which type is not in set {motorway, trunk, primary, secondary, tertiary}.
     :param tolerance: see `osmnx.consolidate_intersections` for detail.
+    :param csr_name: if not None, the map is also saved by `save_graph_csr` in the directory csr_name.
     """
     if custom_filter is None and way_type is None:
         raise Exception('custom_filter and way_type cannot both be None.')
@@ -121,8 +132,15 @@ def download_map(polygon, file_directory: str, edges_name: str, nodes_name: str,
     print("save shape file complete.")
     _save_graph_osm(G, filepath=file_directory, graph_name=graph_name, dropEdge=dropEdge)
     print("save networkx.MultiDiGraph complete.")
+    if csr_name is not None:
+        save_graph_csr(G, file_directory, csr_name)
+        print("save CSR map complete.")
+    metrics_util.gauge('map_nodes', G.number_of_nodes())
+    metrics_util.gauge('map_edges', G.number_of_edges())
+    metrics_util.log('map', nodes=G.number_of_nodes(), edges=G.number_of_edges(), directory=file_directory)
 
 
+@metrics_util.timed('map_load')
 def load_map(file_directory: str, map_name: str) -> networkx.MultiDiGraph:
     """
     load a map by `pickle`.
@@ -133,3 +151,520 @@ def load_map(file_directory: str, map_name: str) -> networkx.MultiDiGraph:
     map_path = os.path.join(file_directory, map_name)
     with open(map_path, 'rb') as f:
         return pickle.load(f)
+
+
+CSR_VERSION = 1
+
+
+def _highway_name(highway) -> str:
+    """
+    :param highway: the highway attribute of an edge, it may be a list after simplify.
+    :return: highway name, the names of a list are joined by ';'.
+    """
+    if highway is None:
+        return ''
+    if isinstance(highway, (list, tuple)):
+        return ';'.join(str(h) for h in highway)
+    return str(highway)
+
+
+def _edge_osmid(osmid) -> int:
+    """
+    :param osmid: the osmid attribute of an edge, it may be a list before `download_map` converts it.
+    :return: osmid, the first one of a list, -1 if it is missing.
+    """
+    if isinstance(osmid, (list, tuple)):
+        osmid = osmid[0] if len(osmid) != 0 else None
+    try:
+        return int(osmid)
+    except (TypeError, ValueError):
+        return -1
+
+
+def save_graph_csr(G: networkx.MultiDiGraph, file_directory: str, graph_name: str):
+    """
+    save map as flat numpy arrays in CSR adjacency form. The map is saved in the directory `graph_name`, every array
+    is a .npy file, so the map can be memory-mapped by many processes. See `load_graph_csr`.
+    :param G: the map.
+    :param file_directory: the map files will be saved in file_directory.
+    :param graph_name: map directory name.
+    """
+    path = os.path.join(file_directory, graph_name)
+    os.makedirs(path, exist_ok=True)
+    node_id = np.array(sorted(G.nodes), dtype=np.int64)
+    node_x = np.array([G.nodes[n]['x'] for n in node_id.tolist()], dtype=np.float64)
+    node_y = np.array([G.nodes[n]['y'] for n in node_id.tolist()], dtype=np.float64)
+    edges = list(G.edges(keys=True, data=True))
+    source = np.searchsorted(node_id, np.array([u for u, _, _, _ in edges], dtype=np.int64))
+    order = np.argsort(source, kind='stable')
+    edges = [edges[i] for i in order.tolist()]
+    source = source[order]
+    target = np.searchsorted(node_id, np.array([v for _, v, _, _ in edges], dtype=np.int64))
+    highway_names = sorted({_highway_name(data.get('highway')) for _, _, _, data in edges})
+    highway_index = {name: i for i, name in enumerate(highway_names)}
+    geom_x, geom_y, geom_offsets, has_geometry = [], [], [0], []
+    for (u, v, _, data), s, t in zip(edges, source.tolist(), target.tolist()):
+        if 'geometry' in data:
+            xs, ys = data['geometry'].xy
+            geom_x.extend(xs)
+            geom_y.extend(ys)
+            has_geometry.append(True)
+        else:
+            geom_x.extend((node_x[s], node_x[t]))
+            geom_y.extend((node_y[s], node_y[t]))
+            has_geometry.append(False)
+        geom_offsets.append(len(geom_x))
+    arrays = {
+        'node_id': node_id,
+        'node_x': node_x,
+        'node_y': node_y,
+        'indptr': np.concatenate(([0], np.cumsum(np.bincount(source, minlength=len(node_id))))).astype(np.int64),
+        'edge_source': source.astype(np.int64),
+        'edge_target': target.astype(np.int64),
+        'edge_key': np.array([key for _, _, key, _ in edges], dtype=np.int64),
+        'edge_osmid': np.array([_edge_osmid(data.get('osmid')) for _, _, _, data in edges], dtype=np.int64),
+        'edge_highway': np.array([highway_index[_highway_name(data.get('highway'))] for _, _, _, data in edges],
+                                 dtype=np.int32),
+        'edge_length': np.array([data.get('length', np.nan) for _, _, _, data in edges], dtype=np.float64),
+        'edge_has_geometry': np.array(has_geometry, dtype=bool),
+        'geom_offsets': np.array(geom_offsets, dtype=np.int64),
+        'geom_x': np.array(geom_x, dtype=np.float64),
+        'geom_y': np.array(geom_y, dtype=np.float64),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+    meta = {'version': CSR_VERSION, 'crs': str(G.graph.get('crs')), 'highway_names': highway_names}
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+@metrics_util.timed('map_load')
+def load_graph_csr(file_directory: str, graph_name: str, mmap=True) -> dict:
+    """
+    load a map saved by `save_graph_csr`. The edges of the i-th node are `indptr[i]:indptr[i + 1]`, the geometry of
+    the j-th edge is `geom_x[geom_offsets[j]:geom_offsets[j + 1]]` and `geom_y[...]`.
+    :param file_directory: the file_directory which map files are saved.
+    :param graph_name: map directory name.
+    :param mmap: if True, the arrays are memory-mapped read-only, the memory is shared by processes.
+    :return: a dict of arrays, 'meta' is the dict of crs and highway names.
+    """
+    path = os.path.join(file_directory, graph_name)
+    with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+        res = {'meta': json.load(f)}
+    for name in os.listdir(path):
+        if name.endswith('.npy'):
+            res[name[:-4]] = np.load(os.path.join(path, name), mmap_mode='r' if mmap else None)
+    return res
+
+
+def csr_to_graph(csr: dict) -> networkx.MultiDiGraph:
+    """
+    convert a map loaded by `load_graph_csr` to networkx.MultiDiGraph.
+    :param csr: the map.
+    :return: map
+    """
+    crs = csr['meta']['crs']
+    G = networkx.MultiDiGraph(crs=None if crs == 'None' else crs)
+    node_id = csr['node_id'].tolist()
+    for n, x, y in zip(node_id, csr['node_x'].tolist(), csr['node_y'].tolist()):
+        G.add_node(n, x=x, y=y)
+    highway_names = csr['meta']['highway_names']
+    geom_offsets = csr['geom_offsets']
+    for i, (s, t, key, osmid, highway, length, has_geometry) in enumerate(zip(
+            csr['edge_source'].tolist(), csr['edge_target'].tolist(), csr['edge_key'].tolist(),
+            csr['edge_osmid'].tolist(), csr['edge_highway'].tolist(), csr['edge_length'].tolist(),
+            csr['edge_has_geometry'].tolist())):
+        data = {'osmid': osmid, 'highway': highway_names[highway], 'length': length}
+        if has_geometry:
+            begin, end = geom_offsets[i], geom_offsets[i + 1]
+            data['geometry'] = LineString(np.column_stack((csr['geom_x'][begin:end], csr['geom_y'][begin:end])))
+        G.add_edge(node_id[s], node_id[t], key=key, **data)
+    return G
+
+
+MAIN_HIGHWAYS = ('motorway', 'trunk', 'primary', 'secondary', 'tertiary')
+TILE_VERSION = 2
+
+
+@metrics_util.timed('map_read')
+def read_osm_file(file_path: str, polygon=None) -> networkx.MultiDiGraph:
+    """
+    read the unsimplified map of a local OSM extract, e.g. a bbbike extract.
+    :param file_path: a .osm (xml) file, or a .osm.pbf / .pbf file which needs pyrosm.
+    :param polygon: if not None, the map is truncated by it.
+    :return: map
+    """
+    if file_path.endswith('.pbf'):
+        try:
+            from pyrosm import OSM
+        except ImportError:
+            raise Exception('pyrosm is not installed, it is needed to read pbf files. Use a .osm file instead.')
+        osm = OSM(file_path)
+        nodes, edges = osm.get_network(network_type='driving', nodes=True)
+        G = osm.to_graph(nodes, edges, graph_type='networkx')
+        G.graph.setdefault('crs', 'epsg:4326')
+    else:
+        G = ox.graph_from_xml(file_path, bidirectional=False, simplify=False, retain_all=True)
+    if polygon is not None:
+        G = ox.truncate.truncate_graph_polygon(G, polygon, truncate_by_edge=True)
+    return G
+
+
+def _tile_grid(polygon, tile_size: float) -> (tuple, int, int):
+    """
+    :param polygon: the boundaries of map.
+    :param tile_size: the width and height of a tile, degree.
+    :return: the bounds of polygon, the number of tile columns and rows.
+    """
+    min_x, min_y, max_x, max_y = polygon.bounds
+    return (min_x, min_y, max_x, max_y), max(int(np.ceil((max_x - min_x) / tile_size)), 1), \
+        max(int(np.ceil((max_y - min_y) / tile_size)), 1)
+
+
+def _tile_owner(x, y, bounds: tuple, tile_size: float, columns: int, rows: int) -> np.ndarray:
+    """
+    :return: the index of the tile whose core contains every point, the points out of the grid belong to the
+    nearest tile.
+    """
+    i = np.clip(((np.asarray(x) - bounds[0]) // tile_size).astype(np.int64), 0, columns - 1)
+    j = np.clip(((np.asarray(y) - bounds[1]) // tile_size).astype(np.int64), 0, rows - 1)
+    return j * columns + i
+
+
+def _filter_highways(G: networkx.MultiDiGraph, highways):
+    """
+    remove the edges whose highway type is not in highways, and the nodes without edges.
+    :param G: map, it is changed.
+    :param highways: the highway types to keep. If None, nothing is removed.
+    """
+    if highways is None:
+        return
+    highways = set(highways)
+    G.remove_edges_from([(u, v, k) for u, v, k, highway in G.edges(keys=True, data='highway')
+                         if not highways.intersection(highway if isinstance(highway, list) else [highway])])
+    G.remove_nodes_from([n for n in list(G.nodes) if G.degree(n) == 0])
+
+
+def _tile_graphs(G: networkx.MultiDiGraph, polygon, tile_size: float, overlap: float, border: bool) -> list:
+    """
+    split a map to tiles, every node is owned by the tile containing it, its attribute 'tile' is the tile index.
+    :param G: map, the node attributes are changed.
+    :param polygon: the boundaries of map.
+    :param tile_size: see `build_map`.
+    :param overlap: see `build_map`.
+    :param border: if True, the nodes of the edges between two tiles get the attribute 'border'.
+    :return: a list of (tile index, the map of the tile). The map of a tile has its own nodes, their neighbors and
+    the nodes within overlap of the tile.
+    """
+    bounds, columns, rows = _tile_grid(polygon, tile_size)
+    node_ids = list(G.nodes)
+    node_x = np.array([G.nodes[n]['x'] for n in node_ids], dtype=np.float64)
+    node_y = np.array([G.nodes[n]['y'] for n in node_ids], dtype=np.float64)
+    owner = _tile_owner(node_x, node_y, bounds, tile_size, columns, rows)
+    networkx.set_node_attributes(G, dict(zip(node_ids, owner.tolist())), 'tile')
+    if border:
+        networkx.set_node_attributes(G, {n: True for u, v in G.edges() if G.nodes[u]['tile'] != G.nodes[v]['tile']
+                                         for n in (u, v)}, 'border')
+    res = []
+    for tile_index in np.unique(owner).tolist():
+        i, j = tile_index % columns, tile_index // columns
+        tile = shapely.box(bounds[0] + i * tile_size - overlap, bounds[1] + j * tile_size - overlap,
+                           bounds[0] + (i + 1) * tile_size + overlap, bounds[1] + (j + 1) * tile_size + overlap)
+        tile_nodes = {n for n, inside in zip(node_ids, data_util.contains_points(tile, node_x, node_y).tolist())
+                      if inside}
+        for n in [node_ids[k] for k in np.flatnonzero(owner == tile_index).tolist()]:
+            tile_nodes.add(n)
+            tile_nodes.update(G.successors(n))
+            tile_nodes.update(G.predecessors(n))
+        res.append((tile_index, G.subgraph(tile_nodes).copy()))
+    return res
+
+
+def _tile_key(G: networkx.MultiDiGraph, params: tuple) -> str:
+    """
+    :param G: the map of a tile.
+    :param params: the build parameters.
+    :return: the hash of the tile content and the parameters, the key of the tile cache.
+    """
+    sha1 = hashlib.sha1(repr((TILE_VERSION, params)).encode('utf-8'))
+    nodes = sorted((n, data['x'], data['y'], data.get('tile'), bool(data.get('border')), data.get('street_count'))
+                   for n, data in G.nodes(data=True))
+    sha1.update(repr(nodes).encode('utf-8'))
+    edges = sorted((u, v, k, repr(data.get('osmid')), _highway_name(data.get('highway')))
+                   for u, v, k, data in G.edges(keys=True, data=True))
+    sha1.update(repr(edges).encode('utf-8'))
+    for u, v, k, geometry in sorted(G.edges(keys=True, data='geometry'), key=lambda e: e[:3]):
+        if geometry is not None:
+            sha1.update(geometry.wkb)
+    return sha1.hexdigest()
+
+
+def _tile_result(G: networkx.MultiDiGraph, owner: dict, tile_index: int, node_ids) -> dict:
+    """
+    :param G: the simplified or consolidated map of a tile.
+    :param owner: the tile index of every node before simplify or consolidate.
+    :param tile_index: tile index.
+    :param node_ids: a function of a node to the list of its ids shared by the tiles.
+    :return: a dict of 'nodes', a list of (x, y, shared ids), and 'edges', a list of (u, v, attributes, coordinates)
+    of the edges starting at a node owned by the tile, u and v are indexes of 'nodes'.
+    """
+    edges = [(u, v, k, data) for u, v, k, data in G.edges(keys=True, data=True)
+             if owner.get(data.get('u_original', u)) == tile_index]
+    used = {u for u, _, _, _ in edges} | {v for _, v, _, _ in edges}
+    nodes = sorted(used, key=lambda n: (G.nodes[n]['x'], G.nodes[n]['y']))
+    local = {n: i for i, n in enumerate(nodes)}
+    res = []
+    for u, v, k, data in sorted(edges, key=lambda e: (local[e[0]], local[e[1]], e[2])):
+        if 'geometry' in data:
+            coordinates = list(data['geometry'].coords)
+        else:
+            coordinates = [(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])]
+        attributes = {key: value for key, value in data.items()
+                      if key in ('highway', 'name', 'oneway', 'lanes', 'maxspeed', 'length')}
+        res.append((local[u], local[v], attributes, coordinates))
+    return {'nodes': [(G.nodes[n]['x'], G.nodes[n]['y'], node_ids(n)) for n in nodes], 'edges': res}
+
+
+def _simplify_tile(args: tuple) -> dict:
+    """
+    simplify the map of a tile in a worker process. The nodes with the attribute 'border' are always kept, so an
+    edge between two tiles is never merged into a longer edge.
+    :param args: (tile index, the unsimplified map of the tile).
+    :return: see `_tile_result`, the shared ids of a node are its border osm ids.
+    """
+    tile_index, G = args
+    owner = dict(G.nodes(data='tile'))
+    if 'node_attrs_include' in inspect.signature(ox.simplify_graph).parameters:
+        G = ox.simplify_graph(G, node_attrs_include=['border'], remove_rings=True)
+    else:
+        # osmnx < 2.0: in strict mode a node is an endpoint if its edges have different osmid.
+        for u, v, k in list(G.out_edges([n for n, border in G.nodes(data='border') if border], keys=True)):
+            G.edges[u, v, k]['osmid'] = f'{G.edges[u, v, k].get("osmid")}-border'
+        G = ox.simplify_graph(G, strict=True, remove_rings=True)
+    return _tile_result(G, owner, tile_index, lambda n: [n] if G.nodes[n].get('border') else [])
+
+
+def _consolidate_tile(args: tuple) -> dict:
+    """
+    consolidate the intersections of the map of a tile in a worker process, see `download_map`.
+    :param args: (tile index, the simplified map of the tile, tolerance).
+    :return: see `_tile_result`, the shared ids of a node are the ids of the merged nodes.
+    """
+    tile_index, G, tolerance = args
+    owner = dict(G.nodes(data='tile'))
+    crs = G.graph['crs']
+    G = ox.consolidate_intersections(ox.project_graph(G), tolerance=tolerance, rebuild_graph=True, dead_ends=False,
+                                     reconnect_edges=True)
+    # all the edges of the tile may be removed with the dead ends.
+    if G.number_of_edges() == 0:
+        return {'nodes': [], 'edges': []}
+    G = ox.project_graph(G, to_crs=crs)
+
+    def node_ids(n):
+        original = G.nodes[n].get('osmid_original', n)
+        return original if isinstance(original, list) else [original]
+
+    return _tile_result(G, owner, tile_index, node_ids)
+
+
+def _build_tiles(func, tasks: list, params: tuple, cache_directory: str, workers: int) -> (list, int):
+    """
+    build the tiles in worker processes, the result of a tile is cached by the hash of its content.
+    :param func: `_simplify_tile` or `_consolidate_tile`.
+    :param tasks: see `_tile_graphs`.
+    :param params: the other arguments of func.
+    :param cache_directory: the directory of the tile cache.
+    :param workers: the number of worker processes. If None, use all cores.
+    :return: a list of (tile index, the result of func), sorted by tile index, and the number of built tiles.
+    """
+    results, build, paths = [], [], {}
+    for tile_index, tile_G in tasks:
+        key = _tile_key(tile_G, (func.__name__, params, tile_index))
+        cache_path = os.path.join(cache_directory, f'tile_{key[:16]}.pkl')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                results.append((tile_index, pickle.load(f)))
+        else:
+            build.append((tile_index, tile_G) + params)
+            paths[tile_index] = cache_path
+    print(f'{func.__name__}: {len(tasks)} tiles, {len(results)} cached, {len(build)} to build.')
+    if len(build) != 0:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers == 1 or len(build) == 1:
+            built = map(func, build)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(min(workers, len(build)))
+            built = pool.imap(func, build)
+        try:
+            for task, result in zip(build, built):
+                temp_path = f'{paths[task[0]]}.{os.getpid()}.tmp'
+                with open(temp_path, 'wb') as f:
+                    pickle.dump(result, f)
+                os.replace(temp_path, paths[task[0]])
+                results.append((task[0], result))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    results.sort(key=lambda result: result[0])
+    return results, len(build)
+
+
+def _stitch_tiles(results: list, crs, stride: int) -> (networkx.MultiDiGraph, dict):
+    """
+    stitch the tiles to one map. The nodes of different tiles sharing an id are the same node. The id of a node is
+    tile index * stride + the index in the first tile having it, the 'osmid' of an edge is tile index * stride + the
+    index in its tile, so the ids of an unchanged tile are stable.
+    :param results: a list of (tile index, see `_tile_result`), sorted by tile index.
+    :param crs: crs of map.
+    :param stride: see above, larger than the number of nodes and edges of a tile.
+    :return: map, and a dict of node to its shared ids.
+    """
+    parent = {}
+
+    def find(n):
+        while parent.setdefault(n, n) != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    # a consolidated node may contain several nodes, they are all the same node.
+    for _, result in results:
+        for _, _, ids in result['nodes']:
+            for n in ids[1:]:
+                parent[find(n)] = find(ids[0])
+    G = networkx.MultiDiGraph(crs=crs)
+    node_id, shared = {}, {}
+    for tile_index, result in results:
+        if len(result['nodes']) > stride or len(result['edges']) > stride:
+            raise Exception(f'tile {tile_index} has more than {stride} nodes or edges, use a larger stride.')
+        local = []
+        for i, (x, y, ids) in enumerate(result['nodes']):
+            key = ('shared', find(ids[0])) if len(ids) != 0 else ('tile', tile_index, i)
+            if key not in node_id:
+                node_id[key] = tile_index * stride + i
+                G.add_node(node_id[key], x=x, y=y)
+            local.append(node_id[key])
+            shared.setdefault(node_id[key], set()).update(ids)
+        for i, (u, v, attributes, coordinates) in enumerate(result['edges']):
+            u, v = local[u], local[v]
+            # the end nodes of an edge between tiles may be moved by the consolidation of the other tile.
+            coordinates = [(G.nodes[u]['x'], G.nodes[u]['y'])] + coordinates[1:-1] + [(G.nodes[v]['x'],
+                                                                                        G.nodes[v]['y'])]
+            G.add_edge(u, v, osmid=tile_index * stride + i, geometry=LineString(coordinates), **attributes)
+    return G, shared
+
+
+def _is_through(G: networkx.MultiDiGraph, node) -> bool:
+    """
+    :return: whether the node is only a vertex of a road, i.e. not an endpoint of `ox.simplify_graph` in strict mode.
+    """
+    neighbors = set(G.predecessors(node)) | set(G.successors(node))
+    return node not in neighbors and G.in_degree(node) != 0 and G.out_degree(node) != 0 and len(neighbors) == 2 \
+        and G.degree(node) in (2, 4)
+
+
+def _merge_through(G: networkx.MultiDiGraph, node):
+    """
+    merge the edges into and out of a node that is only a vertex of a road like `ox.simplify_graph`, and remove the
+    node.
+    :param G: map, it is changed.
+    :param node: node id.
+    """
+    if not _is_through(G, node):
+        return
+    for u, _, in_data in list(G.in_edges(node, data=True)):
+        v, out_data = next((v, data) for _, v, data in G.out_edges(node, data=True) if v != u or G.degree(node) == 2)
+        data = {}
+        for key in in_data.keys() | out_data.keys():
+            values = []
+            for value in (in_data.get(key), out_data.get(key)):
+                for item in value if isinstance(value, list) else [value]:
+                    if item is not None and item not in values:
+                        values.append(item)
+            if len(values) != 0:
+                data[key] = values[0] if len(values) == 1 else values
+        data['osmid'] = in_data['osmid']
+        data['geometry'] = LineString(list(in_data['geometry'].coords) + list(out_data['geometry'].coords)[1:])
+        if 'length' in in_data and 'length' in out_data:
+            data['length'] = in_data['length'] + out_data['length']
+        G.add_edge(u, v, **data)
+    G.remove_node(node)
+
+
+@metrics_util.timed('map_build')
+def build_map(osm_path: str, polygon, file_directory: str, edges_name: str, nodes_name: str, origin_graph_name: str,
+              graph_name: str, tile_size=0.05, overlap=0.005, workers: int = None, highways=MAIN_HIGHWAYS,
+              simplify=True, consolidate=True, tolerance=48, dropEdge=True, csr_name: str = None,
+              cache_directory: str = None, stride=1000000):
+    """
+    build a map from a local OSM extract without network, and save it like `download_map`. The polygon is split to
+    tiles of tile_size, every tile is simplified and then consolidated in worker processes, and the two steps are
+    stitched by the node ids shared by the tiles:
+    1. simplify keeps the nodes of the edges between two tiles in both tiles, the tiles are stitched by these osm
+    nodes, and the edges split only by them are merged again, so the map is the same as simplified in one tile.
+    2. consolidate sees the nodes within overlap of a tile, the tiles are stitched by the merged nodes.
+    The result of a tile is cached by the hash of its content, so only the changed tiles are rebuilt.
+    :param osm_path: the .osm or .osm.pbf file, see `read_osm_file`.
+    :param polygon: the boundaries of map.
+    :param file_directory: see `download_map`.
+    :param edges_name: see `download_map`.
+    :param nodes_name: see `download_map`.
+    :param origin_graph_name: see `download_map`.
+    :param graph_name: see `download_map`.
+    :param tile_size: the width and height of a tile, degree.
+    :param overlap: the extension of a tile, degree. It should be larger than the size of a consolidated
+    intersection.
+    :param workers: the number of worker processes. If None, use all cores.
+    :param highways: the highway types to keep, it replaces the custom_filter of `download_map`. If None, all the
+    ways are kept.
+    :param simplify: see `download_map`.
+    :param consolidate: see `download_map`.
+    :param tolerance: see `download_map`.
+    :param dropEdge: see `download_map`.
+    :param csr_name: see `download_map`.
+    :param cache_directory: the directory of the tile cache. If None, it is `file_directory/tile_cache`.
+    :param stride: see `_stitch_tiles`.
+    """
+    os.makedirs(file_directory, exist_ok=True)
+    origin_G = read_osm_file(osm_path, polygon)
+    _save_graph_osm(origin_G, file_directory, origin_graph_name, False)
+    print(f'before simplify, the number of nodes is {origin_G.number_of_nodes()}, '
+          f'the number of edges is {origin_G.number_of_edges()}.')
+    if cache_directory is None:
+        cache_directory = os.path.join(file_directory, 'tile_cache')
+    os.makedirs(cache_directory, exist_ok=True)
+    crs = origin_G.graph['crs']
+    G = origin_G.copy()
+    _filter_highways(G, highways)
+    tiles, built = 0, 0
+    if simplify:
+        tasks = _tile_graphs(G, polygon, tile_size, overlap, True)
+        through = {n for n, border in G.nodes(data='border') if border and _is_through(G, n)}
+        results, count = _build_tiles(_simplify_tile, tasks, (), cache_directory, workers)
+        G, shared = _stitch_tiles(results, crs, stride)
+        for n, ids in shared.items():
+            if len(ids) == 1 and ids <= through:
+                _merge_through(G, n)
+        tiles, built = tiles + len(results), built + count
+    if consolidate:
+        # the street counts of the whole map, so a node cut by the tile is not a dead end of consolidation.
+        networkx.set_node_attributes(G, ox.stats.count_streets_per_node(G), 'street_count')
+        tasks = _tile_graphs(G, polygon, tile_size, overlap, False)
+        results, count = _build_tiles(_consolidate_tile, tasks, (tolerance,), cache_directory, workers)
+        G, _ = _stitch_tiles(results, crs, stride)
+        tiles, built = tiles + len(results), built + count
+    print(f'after build, the number of nodes is {G.number_of_nodes()}, the number of edges is {G.number_of_edges()}.')
+    _save_graph_shapefile_directional(G, filepath=file_directory, edges_name=edges_name, nodes_name=nodes_name)
+    print("save shape file complete.")
+    _save_graph_osm(G, filepath=file_directory, graph_name=graph_name, dropEdge=dropEdge)
+    print("save networkx.MultiDiGraph complete.")
+    if csr_name is not None:
+        save_graph_csr(G, file_directory, csr_name)
+        print("save CSR map complete.")
+    metrics_util.gauge('map_nodes', G.number_of_nodes())
+    metrics_util.gauge('map_edges', G.number_of_edges())
+    metrics_util.log('map', nodes=G.number_of_nodes(), edges=G.number_of_edges(), directory=file_directory,
+                     tiles=tiles, built=built)
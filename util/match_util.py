@@ -6,51 +6,173 @@
 @Version     :   1.0
 @Desciption  :   match util
 '''
+import os
 import sys
 
-sys.path.append("/data/wyt/packages/fmm-master/build/python/")
-from fmm import Network, NetworkGraph, UBODT, FastMapMatchConfig, UBODTGenAlgorithm
-from util import data_util
-import os
+sys.path.append(os.environ.get('FMM_PYTHON_PATH', "/data/wyt/packages/fmm-master/build/python/"))
+try:
+    from fmm import Network, NetworkGraph, UBODT, FastMapMatch, FastMapMatchConfig, UBODTGenAlgorithm, LineString, \
+        Trajectory
+    FMM_AVAILABLE = True
+except ImportError:
+    # fmm is optional, the 'hmm' backend does not need it.
+    FMM_AVAILABLE = False
+from util import data_util, hmm_util, metrics_util
+from util.cache_util import MatchCache
+import hashlib
+import heapq
+import multiprocessing
+import numpy as np
+import resource
+import time
 
 
-def gen_match_config(k=8, radius=100, gps_error=50):
+def _check_fmm():
+    """
+    raise an exception if fmm is not installed.
+    """
+    if not FMM_AVAILABLE:
+        raise Exception('fmm is not installed, set FMM_PYTHON_PATH to its python build or use the hmm backend.')
+
+
+def gen_match_config(k=8, radius=100, gps_error=50, backend='fmm'):
     """
     generate match config.
     :param k: number of candidates.
     :param radius: search radius.
     :param gps_error: GPS error.
+    :param backend: 'fmm' or 'hmm', see `MatchSession`.
     :return:
     """
+    if backend == 'hmm':
+        return hmm_util.HMMMatchConfig(k, radius, gps_error)
+    _check_fmm()
     fmm_config = FastMapMatchConfig(k, radius, gps_error)
     return fmm_config
 
 
-def gen_ubodt(network, graph, file_directory: str, ubodt_name: str):
+def _is_binary_ubodt(ubodt_name: str) -> bool:
+    """
+    :param ubodt_name: ubodt file name.
+    :return: False if the ubodt file is a csv file(.txt or .csv), otherwise True.
+    """
+    return not ubodt_name.lower().endswith(('.txt', '.csv'))
+
+
+def gen_ubodt(network, graph, file_directory: str, ubodt_name: str, delta=0.03, binary: bool = None):
     """
     generate ubodt(Upper bounded origin destination table) file.
     :param network: fmm Network class.
     :param graph: fmm NetworkGraph class.
     :param file_directory: the map files will be saved in file_directory.
     :param ubodt_name: ubodt file name.
+    :param delta: the upper bound of the shortest path, in the unit of the network.
+    :param binary: if True, the ubodt is saved in binary form. If None, it is decided by `_is_binary_ubodt`.
     :return:
     """
+    if binary is None:
+        binary = _is_binary_ubodt(ubodt_name)
     ubodt_gen = UBODTGenAlgorithm(network, graph)
     # The delta is defined as 3 km approximately. 0.03 degrees.
-    ubodt_gen.generate_ubodt(os.path.join(file_directory, ubodt_name), 0.03, binary=False, use_omp=True)
+    ubodt_gen.generate_ubodt(os.path.join(file_directory, ubodt_name), delta, binary=binary, use_omp=True)
 
 
-def get_ubodt(file_directory: str, ubodt_name: str):
+def get_ubodt(file_directory: str, ubodt_name: str, binary: bool = None):
     """
     get ubodt.
     :param file_directory: the file_directory which map files are saved.
     :param ubodt_name:ubodt file name.
+    :param binary: if True, read the ubodt by the binary reader. If None, it is decided by `_is_binary_ubodt`.
     :return: ubodt
     """
+    if binary is None:
+        binary = _is_binary_ubodt(ubodt_name)
+    if binary:
+        return UBODT.read_ubodt_binary(os.path.join(file_directory, ubodt_name))
     ubodt = UBODT.read_ubodt_csv(os.path.join(file_directory, ubodt_name))
     return ubodt
 
 
+def _hash_edge_file(file_directory: str, edge_name: str, delta) -> str:
+    """
+    hash the edge shape file and its sidecar files(.shx, .dbf, ...) together with delta.
+    :param file_directory: the file_directory which map files are saved.
+    :param edge_name: edge shape file name.
+    :param delta: see `gen_ubodt`.
+    :return: hex digest.
+    """
+    stem = os.path.splitext(edge_name)[0]
+    sha1 = hashlib.sha1(repr(float(delta)).encode('utf-8'))
+    for name in sorted(os.listdir(file_directory)):
+        if os.path.splitext(name)[0] != stem:
+            continue
+        sha1.update(name.encode('utf-8'))
+        with open(os.path.join(file_directory, name), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _cached_ubodt_name(file_directory: str, edge_name: str, delta) -> str:
+    """
+    :param file_directory: the file_directory which map files are saved.
+    :param edge_name: edge shape file name.
+    :param delta: see `gen_ubodt`.
+    :return: the name of the cached ubodt file of the edge shape file and delta, see `get_cached_ubodt_name`.
+    """
+    return f'ubodt_{_hash_edge_file(file_directory, edge_name, delta)[:16]}.bin'
+
+
+def get_cached_ubodt_name(network, graph, file_directory: str, edge_name: str, delta=0.03) -> str:
+    """
+    get the binary ubodt file of the edge shape file. The ubodt file is named by the hash of the edge shape file and
+    delta, it is generated only if it does not exist.
+    :param network: fmm Network class.
+    :param graph: fmm NetworkGraph class.
+    :param file_directory: the file_directory which map files are saved.
+    :param edge_name: edge shape file name.
+    :param delta: see `gen_ubodt`.
+    :return: ubodt file name.
+    """
+    ubodt_name = _cached_ubodt_name(file_directory, edge_name, delta)
+    if os.path.exists(os.path.join(file_directory, ubodt_name)):
+        return ubodt_name
+    temp_name = f'{ubodt_name}.{os.getpid()}.tmp'
+    gen_ubodt(network, graph, file_directory, temp_name, delta, binary=True)
+    # other processes never read a partially written file.
+    os.replace(os.path.join(file_directory, temp_name), os.path.join(file_directory, ubodt_name))
+    return ubodt_name
+
+
+def prepare_session_args(session_args: dict) -> dict:
+    """
+    get or generate the ubodt of the fmm session once in this process, before the worker processes load their
+    sessions, so the workers do not generate the same ubodt in parallel on a cold cache.
+    :param session_args: the arguments of `MatchSession`.
+    :return: a copy of session_args whose ubodt_name is an existing ubodt file.
+    """
+    session_args = dict(session_args)
+    if session_args.get('backend', 'fmm') != 'fmm':
+        return session_args
+    file_directory, edge_name = session_args['file_directory'], session_args['edge_name']
+    ubodt_name, delta = session_args.get('ubodt_name'), session_args.get('delta', 0.03)
+    if ubodt_name is None:
+        cached_name = _cached_ubodt_name(file_directory, edge_name, delta)
+        if os.path.exists(os.path.join(file_directory, cached_name)):
+            session_args['ubodt_name'] = cached_name
+            return session_args
+    elif os.path.exists(os.path.join(file_directory, ubodt_name)):
+        return session_args
+    network = get_network(file_directory, edge_name, session_args.get('id', 'fid'), session_args.get('source', 'u'),
+                          session_args.get('target', 'v'))
+    graph = get_graph(network)
+    if ubodt_name is None:
+        session_args['ubodt_name'] = get_cached_ubodt_name(network, graph, file_directory, edge_name, delta)
+    else:
+        gen_ubodt(network, graph, file_directory, ubodt_name, delta)
+    return session_args
+
+
 def get_graph(network):
     """
     get the fmm NetworkGraph class.
@@ -70,67 +192,207 @@ def get_network(file_directory: str, edge_name: str, id='fid', source='u', targe
     :param target: edge shape attribute, edge target.
     :return:
     """
+    _check_fmm()
     network = Network(os.path.join(file_directory, edge_name), id, source, target)
     return network
 
 
-def _gen_trajectory(points) -> str:
+def _gen_tokens(x, y) -> list:
+    """
+    convert coordinates to the coordinate tokens of LINESTRING. The tokens are generated once and sliced for any
+    part of the trajectory.
+    :param x: longitude array.
+    :param y: latitude array.
+    :return: tokens, 'longitude latitude' of each point.
     """
-    convert points list to LINESTRING.
-    :param points:
+    return [f'{px} {py}' for px, py in zip(np.asarray(x).tolist(), np.asarray(y).tolist())]
+
+
+def _gen_trajectory(tokens: list) -> str:
+    """
+    convert tokens to LINESTRING.
+    :param tokens: the tokens of points, see `_gen_tokens`.
     :return: LINESTRING
     """
-    trajectory = ''
-    for point in points:
-        trajectory += str(point['longitude'])
-        trajectory += ' '
-        trajectory += str(point['latitude'])
-        trajectory += ','
-    wkt = "LINESTRING({})".format(trajectory)
+    return "LINESTRING({})".format(','.join(tokens))
 
-    return wkt
 
+def _gen_linestring(x, y):
+    """
+    convert coordinates to fmm LineString without formatting them as text.
+    :param x: longitude array.
+    :param y: latitude array.
+    :return: fmm LineString.
+    """
+    geom = LineString()
+    for px, py in zip(np.asarray(x, dtype=np.float64).tolist(), np.asarray(y, dtype=np.float64).tolist()):
+        geom.add_point(px, py)
+    return geom
 
-def _get_fix_traj(res_wkt) -> list:
+
+def _get_fix_traj(mgeom_x, mgeom_y) -> list:
     """
-    convert fmm result to points list.
-    :param res_wkt: fmm result.
+    convert the matched geometry to points list.
+    :param mgeom_x: longitude array of the matched geometry.
+    :param mgeom_y: latitude array of the matched geometry.
     :return: points list.
     """
-    s = res_wkt[11:-1]
-    coors = s.split(',')
-    points = []
-    for coor in coors:
-        temp = coor.split(' ')
-        if temp is None or len(temp) != 2:
+    return [{'latitude': py, 'longitude': px, 'y': py, 'x': px}
+            for px, py in zip(mgeom_x.tolist(), mgeom_y.tolist())]
+
+
+def _match(x, y, fmm_model, fmm_config) -> dict:
+    """
+    match a continuous trajectory.
+    :param x: longitude array.
+    :param y: latitude array.
+    :param fmm_model: fmm model or `hmm_util.HMMMatcher`.
+    :param fmm_config: fmm config.
+    :return: a dict of numpy arrays, 'opath', 'cpath', 'mgeom_x' and 'mgeom_y'. Opath is the optimal path,
+    containing id of edges matched to each point in a trajectory. Opath is empty if the trajectory can not be matched.
+    """
+    if isinstance(fmm_model, hmm_util.HMMMatcher):
+        return fmm_model.match(x, y, fmm_config)
+    result = fmm_model.match_traj(Trajectory(0, _gen_linestring(x, y)), fmm_config)
+    mgeom = result.mgeom
+    n = mgeom.get_num_points()
+    return {'opath': np.array(result.opath, dtype=np.int64).reshape(-1),
+            'cpath': np.array(result.cpath, dtype=np.int64).reshape(-1),
+            'mgeom_x': np.fromiter((mgeom.get_x(i) for i in range(n)), dtype=np.float64, count=n),
+            'mgeom_y': np.fromiter((mgeom.get_y(i) for i in range(n)), dtype=np.float64, count=n)}
+
+
+def _split_tokens(fmm_model, tokens: list, fmm_config, window_size=128) -> list:
+    """
+    find the ranges of the continuous parts of a trajectory in one pass. See `split_points`.
+    :param fmm_model: fmm model.
+    :param tokens: the tokens of points, see `_gen_tokens`.
+    :param fmm_config: fmm config.
+    :param window_size: the number of points checked by one `check_match_wkt` call, at least 2.
+    :return: a list of (begin, end).
+    """
+    window_size = max(window_size, 2)
+    ranges = []
+    begin = 0
+    window_begin = 0
+    while window_begin < len(tokens):
+        window_end = min(window_begin + window_size, len(tokens))
+        wkt = _gen_trajectory(tokens[window_begin:window_end])
+        _result = int(fmm_model.check_match_wkt(wkt, fmm_config))
+        if _result == -1:
+            if window_end == len(tokens):
+                break
+            window_begin = window_end - 1
             continue
-        tax = {'latitude': float(temp[1]), 'longitude': float(temp[0])}
-        tax['y'] = tax['latitude']
-        tax['x'] = tax['longitude']
-        points.append(tax)
-    return points
+        end = window_begin + _result + 1
+        ranges.append((begin, end))
+        begin = end
+        window_begin = end
+    if begin < len(tokens):
+        ranges.append((begin, len(tokens)))
+    return ranges
+
+
+def split_points(fmm_model, points, fmm_config, window_size=128) -> list:
+    """
+    find the ranges of the continuous parts of a trajectory in one pass. `check_match_wkt` is called on windows of
+    at most window_size points, consecutive windows share one point, so every point is checked at most twice.
+    :param fmm_model: fmm model.
+    :param points: trajectory.
+    :param fmm_config: fmm config.
+    :param window_size: the number of points checked by one `check_match_wkt` call, at least 2.
+    :return: a list of (begin, end), points[begin:end] can be matched.
+    """
+    tokens = _gen_tokens([point['longitude'] for point in points], [point['latitude'] for point in points])
+    return _split_tokens(fmm_model, tokens, fmm_config, window_size)
+
+
+@metrics_util.timed('match', 'match_latency_seconds')
+def match_arrays(fmm_model, x, y, fmm_config, t=None, window_size=128) -> dict:
+    """
+    match a trajectory given as coordinate arrays. Due to some trajectories are discontinuous, the trajectory is
+    split by `split_points` and every continuous part is matched.
+    :param fmm_model: fmm model or `hmm_util.HMMMatcher`.
+    :param x: longitude array.
+    :param y: latitude array.
+    :param fmm_config: fmm config.
+    :param t: time array. If not None, the speed of each point is calculated by `data_util.compute_speed`.
+    :param window_size: see `split_points`.
+    :return: a dict of numpy arrays.
+    'offsets': the i-th continuous part is points [offsets[i], offsets[i + 1]).
+    'opath': the edge id of each point, -1 if the point's part can not be matched.
+    'speed': the speed of each point, only if t is not None.
+    'cpath', 'cpath_offsets': the complete path of each part.
+    'mgeom_x', 'mgeom_y', 'mgeom_offsets': the matched geometry of each part.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if isinstance(fmm_model, hmm_util.HMMMatcher):
+        # the parts are decoded together with the split.
+        ranges, results = fmm_model.match_all(x, y, fmm_config)
+    else:
+        ranges = _split_tokens(fmm_model, _gen_tokens(x, y), fmm_config, window_size)
+        results = (_match(x[begin:end], y[begin:end], fmm_model, fmm_config) for begin, end in ranges)
+    opath = np.full(len(x), -1, dtype=np.int64)
+    cpaths, mgeom_xs, mgeom_ys = [], [], []
+    for (begin, end), result in zip(ranges, results):
+        if len(result['opath']) == end - begin:
+            opath[begin:end] = result['opath']
+        cpaths.append(result['cpath'])
+        mgeom_xs.append(result['mgeom_x'])
+        mgeom_ys.append(result['mgeom_y'])
+    offsets = np.array([0] + [end for _, end in ranges], dtype=np.int64)
+    res = {'offsets': offsets, 'opath': opath,
+           'cpath': np.concatenate(cpaths) if cpaths else np.zeros(0, dtype=np.int64),
+           'cpath_offsets': np.cumsum([0] + [len(c) for c in cpaths]).astype(np.int64),
+           'mgeom_x': np.concatenate(mgeom_xs) if mgeom_xs else np.zeros(0),
+           'mgeom_y': np.concatenate(mgeom_ys) if mgeom_ys else np.zeros(0),
+           'mgeom_offsets': np.cumsum([0] + [len(m) for m in mgeom_xs]).astype(np.int64)}
+    if metrics_util.enabled:
+        matched = int((opath >= 0).sum())
+        metrics_util.count('points_matched', matched)
+        metrics_util.count('points_unmatched', len(opath) - matched)
+    if t is not None:
+        res['speed'] = data_util.compute_speed(x, y, t, offsets)
+    return res
 
 
-def _match(points, fmm_model, fmm_config):
+def _match_with_model(fmm_model, points, fmm_config) -> (list, list):
     """
-    :param points: trajectory that is going to be matched.
+    match points with a built fmm model. See `match_points`.
     :param fmm_model: fmm model.
+    :param points: trajectory.
     :param fmm_config: fmm config.
-    :return: opath and the repair trajectory. Opath is the optimal path, containing id of edges matched to each point in a trajectory.
+    :return: opath and the repair trajectory.
+    """
+    result = match_arrays(fmm_model, [point['longitude'] for point in points],
+                          [point['latitude'] for point in points], fmm_config,
+                          t=[point['time'] for point in points])
+    return _apply_result(points, result)
+
+
+def _apply_result(points, result: dict) -> (list, list):
+    """
+    set the opath and speed of points from the result of `match_arrays`.
+    :param points: trajectory.
+    :param result: the result of `match_arrays` with 'speed'.
+    :return: opath and the repair trajectory.
     """
-    wkt = _gen_trajectory(points)
-    result = fmm_model.match_wkt(wkt, fmm_config)
-    fix_traj = _get_fix_traj(result.mgeom.export_wkt())
-    points_opath = []
-    for path, point in zip(list(result.opath), points):
+    points_with_opath = []
+    for point, path, speed in zip(points, result['opath'].tolist(), result['speed'].tolist()):
+        if path == -1:
+            continue
         point['opath'] = path
-        points_opath.append(point)
-    return points_opath, fix_traj
+        point['speed_cal'] = speed
+        points_with_opath.append(point)
+    fix_trajectory = _get_fix_traj(result['mgeom_x'], result['mgeom_y'])
+    return points_with_opath, fix_trajectory
 
 
 def match_points(ubodt, graph, network, points, fmm_config) -> (list, list):
     """
     match points. Due to some trajectories are discontinuous, match algorithm will be called multi times.
+    The fmm model is built at every call, use `MatchSession` to match many trajectories.
     :param ubodt: ubodt.
     :param graph: fmm NetworkGraph class.
     :param network: fmm Network class.
@@ -138,24 +400,239 @@ def match_points(ubodt, graph, network, points, fmm_config) -> (list, list):
     :param fmm_config: fmm config.
     :return: opath and the repair trajectory. Opath is the optimal path, containing id of edges matched to each point in a trajectory.
     """
-    wkt = _gen_trajectory(points)
+    _check_fmm()
     fmm_model = FastMapMatch(network, graph, ubodt)
-    points_with_opath = []
-    fix_trajectory = []
-    while True:
-        _result = fmm_model.check_match_wkt(wkt, fmm_config)
-        if int(_result) == -1:
-            points_opath, fix_traj = _match(points, fmm_model, fmm_config)
-            data_util.gen_speed(points_opath)
-            points_with_opath += points_opath
-            fix_trajectory += fix_traj
-            break
-        first = points[:int(_result) + 1]
-        points_opath, fix_traj = _match(first, fmm_model, fmm_config)
-        # generate each point group's speed
-        data_util.gen_speed(points_opath)
-        points_with_opath += points_opath
-        fix_trajectory += fix_traj
-        points = points[int(_result) + 1:]
-        wkt = _gen_trajectory(points)
-    return points_with_opath, fix_trajectory
+    return _match_with_model(fmm_model, points, fmm_config)
+
+
+def _get_rss() -> int:
+    """
+    get the resident set size of this process.
+    :return: bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # the peak resident set size, kilobytes on linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MatchSession:
+    """
+    A match session loads the network, graph, ubodt and the fmm model once and reuses them for every match.
+    With the 'hmm' backend, the session loads `hmm_util.HMMMatcher` from the same edge shape file instead, fmm is not
+    needed.
+    """
+
+    @metrics_util.timed('session_load')
+    def __init__(self, file_directory: str, edge_name: str, ubodt_name: str = None, k=8, radius=100, gps_error=50,
+                 id='fid', source='u', target='v', delta=0.03, backend='fmm', cache: MatchCache = None):
+        """
+        :param file_directory: the file_directory which map files are saved.
+        :param edge_name: edge shape file name.
+        :param ubodt_name: ubodt file name. If the file does not exist, it will be generated. If None, the binary
+        ubodt cached by `get_cached_ubodt_name` is used.
+        :param k: number of candidates.
+        :param radius: search radius.
+        :param gps_error: GPS error.
+        :param id: edge shape attribute, edge id.
+        :param source: edge shape attribute, edge source.
+        :param target: edge shape attribute, edge target.
+        :param delta: see `gen_ubodt`.
+        :param backend: 'fmm' or 'hmm'.
+        :param cache: if not None, the results of near-identical trajectories are reused, see `cache_util.MatchCache`.
+        The cache key includes the hash of the edge shape file, so the results of another map are never reused.
+        """
+        begin_time = time.perf_counter()
+        begin_rss = _get_rss()
+        self.backend = backend
+        self.cache = cache
+        self.config_key = (backend, k, radius, gps_error)
+        if cache is not None:
+            # a persisted cache must not return the edge ids of a rebuilt map.
+            self.config_key += (_hash_edge_file(file_directory, edge_name, delta),)
+        self.fmm_config = gen_match_config(k, radius, gps_error, backend)
+        if backend == 'hmm':
+            self.network = self.graph = self.ubodt = None
+            self.fmm_model = hmm_util.HMMMatcher.from_shapefile(os.path.join(file_directory, edge_name), id, source,
+                                                                target, delta)
+        elif backend == 'fmm':
+            self._load_fmm(file_directory, edge_name, ubodt_name, id, source, target, delta)
+        else:
+            raise Exception(f'unknown match backend: {backend}.')
+        self.load_time = time.perf_counter() - begin_time
+        self.memory_footprint = max(_get_rss() - begin_rss, 0)
+        metrics_util.gauge('session_memory_bytes', self.memory_footprint)
+
+    def _load_fmm(self, file_directory: str, edge_name: str, ubodt_name: str, id, source, target, delta):
+        """
+        load the network, graph, ubodt and fmm model. See `MatchSession`.
+        """
+        self.network = get_network(file_directory, edge_name, id, source, target)
+        self.graph = get_graph(self.network)
+        if ubodt_name is None:
+            ubodt_name = get_cached_ubodt_name(self.network, self.graph, file_directory, edge_name, delta)
+        elif not os.path.exists(os.path.join(file_directory, ubodt_name)):
+            gen_ubodt(self.network, self.graph, file_directory, ubodt_name, delta)
+        self.ubodt = get_ubodt(file_directory, ubodt_name)
+        self.fmm_model = FastMapMatch(self.network, self.graph, self.ubodt)
+
+    def match(self, points) -> (list, list):
+        """
+        match a trajectory. See `match_points`.
+        :param points: trajectory.
+        :return: opath and the repair trajectory.
+        """
+        result = self.match_arrays([point['longitude'] for point in points], [point['latitude'] for point in points],
+                                   [point['time'] for point in points])
+        return _apply_result(points, result)
+
+    def match_arrays(self, x, y, t=None) -> dict:
+        """
+        match a trajectory given as coordinate arrays. See `match_arrays`.
+        :param x: longitude array.
+        :param y: latitude array.
+        :param t: time array.
+        :return: a dict of numpy arrays.
+        """
+        if self.cache is None or len(x) == 0:
+            return match_arrays(self.fmm_model, x, y, self.fmm_config, t)
+        key = self.cache.fingerprint(x, y, self.config_key)
+        result = self.cache.get(key, x, y)
+        if result is None:
+            metrics_util.count('cache_misses')
+            result = match_arrays(self.fmm_model, x, y, self.fmm_config)
+            self.cache.put(key, x, y, result)
+        else:
+            metrics_util.count('cache_hits')
+        if t is not None:
+            result['speed'] = data_util.compute_speed(x, y, t, result['offsets'])
+        return result
+
+    def match_many(self, segments):
+        """
+        match many trajectories.
+        :param segments: an iterable of trajectories.
+        :return: a generator of (points_with_opath, fix_trajectory) for each trajectory.
+        """
+        for points in segments:
+            yield self.match(points)
+
+    def report(self) -> str:
+        """
+        :return: the load time and memory footprint of this session, and the hit rate of the cache.
+        """
+        res = f'backend: {self.backend}, load time: {self.load_time:.2f}s, ' \
+              f'memory footprint: {self.memory_footprint / 1024 / 1024:.1f}MB.'
+        if self.cache is not None:
+            res += f' cache: {len(self.cache)} entries, hit rate: {self.cache.hit_rate():.2%}.'
+        return res
+
+
+# the match session of a worker process, see `match_fleet`.
+_worker_session = None
+
+
+def _init_worker(session_args: dict):
+    """
+    load the match session once in a worker process.
+    :param session_args: the arguments of `MatchSession`.
+    """
+    global _worker_session
+    # a forked worker starts with a copy of the metrics of the parent.
+    metrics_util.reset()
+    _worker_session = MatchSession(**session_args)
+
+
+def _match_chunk(chunk: list) -> (list, dict):
+    """
+    match a chunk of trajectories in a worker process.
+    :param chunk: a list of (index, points).
+    :return: a list of (index, points_with_opath, fix_trajectory, error), error is None if the match succeeded, and
+    the metrics of the worker to be merged by `metrics_util.merge`.
+    """
+    res = []
+    for index, points in chunk:
+        try:
+            points_with_opath, fix_trajectory = _worker_session.match(points)
+            res.append((index, points_with_opath, fix_trajectory, None))
+            metrics_util.count('segments_matched')
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            res.append((index, [], [], error))
+            metrics_util.count('segments_failed')
+            metrics_util.log('match_failed', index=index, points=len(points), error=error)
+    return res, metrics_util.collect()
+
+
+def _balance_chunks(sizes: list, chunk_number: int) -> list:
+    """
+    distribute the trajectories to chunks whose total points are nearly the same. The largest trajectory is given to
+    the smallest chunk first.
+    :param sizes: the point numbers of trajectories.
+    :param chunk_number: the number of chunks.
+    :return: a list of index lists, empty chunks are removed.
+    """
+    chunk_number = max(min(chunk_number, len(sizes)), 1)
+    heap = [(0, i) for i in range(chunk_number)]
+    chunks = [[] for _ in range(chunk_number)]
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        total, i = heapq.heappop(heap)
+        chunks[i].append(index)
+        heapq.heappush(heap, (total + sizes[index], i))
+    return [chunk for chunk in chunks if len(chunk) != 0]
+
+
+@metrics_util.timed('match_fleet')
+def match_fleet(segments: list, file_directory: str, edge_name: str, ubodt_name: str = None, k=8, radius=100,
+                gps_error=50, workers: int = None, chunks_per_worker=4, session: MatchSession = None,
+                backend='fmm') -> list:
+    """
+    match many trajectories in worker processes. Every worker loads the network, graph and ubodt once: if session is
+    given and the platform supports fork, the workers inherit it, otherwise every worker builds its own session.
+    :param segments: a list of trajectories.
+    :param file_directory: see `MatchSession`.
+    :param edge_name: see `MatchSession`.
+    :param ubodt_name: see `MatchSession`.
+    :param k: see `MatchSession`.
+    :param radius: see `MatchSession`.
+    :param gps_error: see `MatchSession`.
+    :param workers: the number of worker processes. If None, use all cores.
+    :param chunks_per_worker: the trajectories are distributed in workers * chunks_per_worker chunks of nearly the
+    same total points.
+    :param session: a loaded session to be inherited by the workers.
+    :param backend: see `MatchSession`.
+    :return: a list of (points_with_opath, fix_trajectory, error) in the order of segments. error is None if the
+    match succeeded, otherwise it is the error message.
+    """
+    global _worker_session
+    if workers is None:
+        workers = os.cpu_count() or 1
+    session_args = {'file_directory': file_directory, 'edge_name': edge_name, 'ubodt_name': ubodt_name,
+                    'k': k, 'radius': radius, 'gps_error': gps_error, 'backend': backend}
+    chunks = _balance_chunks([len(points) for points in segments], workers * chunks_per_worker)
+    chunks = [[(index, segments[index]) for index in chunk] for chunk in chunks]
+    res = [None] * len(segments)
+    if workers == 1:
+        _worker_session = session if session is not None else MatchSession(**session_args)
+        results = map(_match_chunk, chunks)
+        pool = None
+    elif session is not None and 'fork' in multiprocessing.get_all_start_methods():
+        _worker_session = session
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=metrics_util.reset)
+        results = pool.imap_unordered(_match_chunk, chunks)
+    else:
+        session_args = prepare_session_args(session_args)
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(session_args,))
+        results = pool.imap_unordered(_match_chunk, chunks)
+    try:
+        for chunk, metrics in results:
+            metrics_util.merge(metrics)
+            for index, points_with_opath, fix_trajectory, error in chunk:
+                res[index] = (points_with_opath, fix_trajectory, error)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return res
@@ -0,0 +1,334 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   metrics_util.py
+@Modify Time :   2023/3/22 10:30
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   stage timers, counters and histograms, exported as structured log, json and prometheus text
+'''
+import functools
+import json
+import os
+import threading
+import time
+
+# the metrics are enabled in the processes started with this environment variable, e.g. spawned workers.
+ENV_NAME = 'TRAJECTORY_METRICS'
+PREFIX = 'trajectory'
+# seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+# points
+LENGTH_BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+enabled = os.environ.get(ENV_NAME) == '1'
+_log_stream = None
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+# stage -> [calls, wall seconds, cpu seconds]
+_timers = {}
+# name -> {'buckets': bounds, 'counts': count of every bound and +Inf, 'sum': sum, 'count': count}
+_histograms = {}
+
+
+def _after_fork():
+    """
+    a forked child has a copy of the lock, which may be held by a thread of the parent that does not exist in the
+    child, so the child gets a new lock.
+    """
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def enable(log_stream=None):
+    """
+    enable the metrics in this process and the processes started after it.
+    :param log_stream: a file object of the structured log, one json object per line. If None, `log` does nothing.
+    """
+    global enabled, _log_stream
+    enabled = True
+    _log_stream = log_stream
+    os.environ[ENV_NAME] = '1'
+
+
+def disable():
+    """
+    disable the metrics, the recorded values are kept.
+    """
+    global enabled, _log_stream
+    enabled = False
+    _log_stream = None
+    os.environ.pop(ENV_NAME, None)
+
+
+def reset():
+    """
+    remove all the recorded values.
+    """
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+        _histograms.clear()
+
+
+def count(name: str, value=1):
+    """
+    add value to a counter.
+    :param name: counter name, e.g. 'points_read'.
+    :param value: a non-negative number.
+    """
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name: str, value):
+    """
+    set a gauge.
+    :param name: gauge name, e.g. 'map_edges'.
+    :param value: number.
+    """
+    if not enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, value, buckets=LATENCY_BUCKETS):
+    """
+    add a value to a histogram.
+    :param name: histogram name, e.g. 'match_latency_seconds'.
+    :param value: number.
+    :param buckets: the upper bounds of the buckets, only used when the histogram is created.
+    """
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1),
+                                             'sum': 0.0, 'count': 0}
+        index = 0
+        while index < len(histogram['buckets']) and value > histogram['buckets'][index]:
+            index += 1
+        histogram['counts'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+class _Timer:
+    """
+    A context manager that adds the wall and cpu time of the block to a stage. The cpu time is of this thread.
+    """
+    __slots__ = ('stage', 'wall', 'cpu', 'histogram')
+
+    def __init__(self, stage: str, histogram: str = None):
+        self.stage = stage
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        with _lock:
+            timer = _timers.setdefault(self.stage, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += wall
+            timer[2] += cpu
+        if self.histogram is not None:
+            observe(self.histogram, wall)
+        return False
+
+
+class _NullTimer:
+    """
+    The timer when the metrics are disabled, it does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(stage: str, histogram: str = None):
+    """
+    time a block: `with metrics_util.timer('load'): ...`.
+    :param stage: stage name.
+    :param histogram: if not None, the wall time of every call is also added to this histogram.
+    :return: a context manager.
+    """
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(stage, histogram)
+
+
+def timed(stage: str, histogram: str = None):
+    """
+    a decorator that times every call of a function, see `timer`.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Timer(stage, histogram):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def log(event: str, **fields):
+    """
+    write an event to the structured log if the metrics are enabled with a log stream.
+    :param event: event name.
+    :param fields: json serializable fields.
+    """
+    stream = _log_stream
+    if not enabled or stream is None:
+        return
+    line = json.dumps({'time': time.time(), 'pid': os.getpid(), 'event': event, **fields}, default=str)
+    with _lock:
+        stream.write(line + '\n')
+        stream.flush()
+
+
+def snapshot() -> dict:
+    """
+    :return: a json serializable copy of all the metrics: 'counters', 'gauges', 'timers' (stage to 'calls',
+    'wall_seconds' and 'cpu_seconds') and 'histograms'.
+    """
+    with _lock:
+        return {'counters': dict(_counters), 'gauges': dict(_gauges),
+                'timers': {stage: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu}
+                           for stage, (calls, wall, cpu) in _timers.items()},
+                'histograms': {name: {'buckets': list(h['buckets']), 'counts': list(h['counts']), 'sum': h['sum'],
+                                      'count': h['count']} for name, h in _histograms.items()}}
+
+
+def collect() -> dict:
+    """
+    take the snapshot and reset the metrics. A worker process returns it to be merged by the parent.
+    :return: see `snapshot`, None if the metrics are disabled.
+    """
+    if not enabled:
+        return None
+    with _lock:
+        res = {'counters': dict(_counters), 'gauges': dict(_gauges),
+               'timers': {stage: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu}
+                          for stage, (calls, wall, cpu) in _timers.items()},
+               'histograms': {name: dict(h) for name, h in _histograms.items()}}
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+        _histograms.clear()
+    return res
+
+
+def merge(other: dict):
+    """
+    add the metrics of a snapshot, e.g. of a worker process. Gauges are overwritten.
+    :param other: see `snapshot`. If None, nothing is merged.
+    """
+    if other is None:
+        return
+    with _lock:
+        for name, value in other['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+        _gauges.update(other['gauges'])
+        for stage, value in other['timers'].items():
+            timer = _timers.setdefault(stage, [0, 0.0, 0.0])
+            timer[0] += value['calls']
+            timer[1] += value['wall_seconds']
+            timer[2] += value['cpu_seconds']
+        for name, value in other['histograms'].items():
+            histogram = _histograms.get(name)
+            if histogram is None:
+                _histograms[name] = {'buckets': list(value['buckets']), 'counts': list(value['counts']),
+                                     'sum': value['sum'], 'count': value['count']}
+            elif histogram['buckets'] == list(value['buckets']):
+                histogram['counts'] = [a + b for a, b in zip(histogram['counts'], value['counts'])]
+                histogram['sum'] += value['sum']
+                histogram['count'] += value['count']
+
+
+def to_prometheus(metrics: dict = None) -> str:
+    """
+    :param metrics: see `snapshot`. If None, the current metrics are used.
+    :return: the metrics in the prometheus text exposition format.
+    """
+    metrics = snapshot() if metrics is None else metrics
+    lines = []
+    for name, value in sorted(metrics['counters'].items()):
+        lines += [f'# TYPE {PREFIX}_{name}_total counter', f'{PREFIX}_{name}_total {value}']
+    for name, value in sorted(metrics['gauges'].items()):
+        lines += [f'# TYPE {PREFIX}_{name} gauge', f'{PREFIX}_{name} {value}']
+    if len(metrics['timers']) != 0:
+        for field, kind in (('calls', 'calls_total'), ('wall_seconds', 'wall_seconds_total'),
+                            ('cpu_seconds', 'cpu_seconds_total')):
+            lines.append(f'# TYPE {PREFIX}_stage_{kind} counter')
+            for stage, value in sorted(metrics['timers'].items()):
+                lines.append(f'{PREFIX}_stage_{kind}{{stage="{stage}"}} {value[field]}')
+    for name, value in sorted(metrics['histograms'].items()):
+        lines.append(f'# TYPE {PREFIX}_{name} histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(value['buckets'] + ['+Inf'], value['counts']):
+            cumulative += bucket_count
+            lines.append(f'{PREFIX}_{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f'{PREFIX}_{name}_sum {value["sum"]}', f'{PREFIX}_{name}_count {value["count"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def _write(file_path: str, text: str):
+    """
+    write a file atomically, so a reader (e.g. the node exporter) never sees a partial file.
+    """
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, file_path)
+
+
+def save_json(file_path: str):
+    """
+    save the snapshot as json.
+    :param file_path: file path.
+    """
+    _write(file_path, json.dumps(snapshot(), indent=2))
+
+
+def save_prometheus(file_path: str):
+    """
+    save the metrics as a prometheus text file, e.g. for the textfile collector of the node exporter.
+    :param file_path: file path, it should end with '.prom'.
+    """
+    _write(file_path, to_prometheus())
+
+
+def report() -> str:
+    """
+    :return: a readable summary of the stage timers and counters.
+    """
+    metrics = snapshot()
+    lines = [f'{stage}: {value["calls"]} calls, wall {value["wall_seconds"]:.3f}s, cpu {value["cpu_seconds"]:.3f}s'
+             for stage, value in metrics['timers'].items()]
+    lines += [f'{name}: {value}' for name, value in metrics['counters'].items()]
+    return '\n'.join(lines)
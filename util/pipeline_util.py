@@ -0,0 +1,188 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   pipeline_util.py
+@Modify Time :   2023/3/8 16:40
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   a streaming pipeline: read -> filter -> segment -> match -> write
+'''
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from util import data_util, match_util, metrics_util
+
+# the end of a queue.
+_STOP = object()
+
+
+class Stage:
+    """
+    A stage of pipeline. It gets items from the input queue, calls func in workers threads and puts the results to
+    the output queue. The queues are bounded, so a slow stage blocks the stages before it.
+    """
+
+    def __init__(self, name: str, func, workers=1, queue_size=16, expand=False):
+        """
+        :param name: stage name.
+        :param func: a function of an item. If it returns None, nothing is put to the output queue.
+        :param workers: the number of threads.
+        :param queue_size: the maximum number of items in the input queue.
+        :param expand: if True, func returns an iterable and every element of it is put to the output queue.
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+        self.expand = expand
+        self.count = 0
+        self.errors = []
+
+
+def _run_stage(stage: Stage, input_queue: queue.Queue, output_queue: queue.Queue, next_workers: int,
+               finished: list, lock: threading.Lock):
+    """
+    the loop of a stage worker thread.
+    :param stage: stage.
+    :param input_queue: input queue.
+    :param output_queue: output queue.
+    :param next_workers: the number of workers reading the output queue.
+    :param finished: the number of finished workers of this stage, in a list to be shared.
+    :param lock: the lock of finished.
+    """
+    while True:
+        item = input_queue.get()
+        if item is _STOP:
+            break
+        try:
+            result = stage.func(item)
+            if stage.expand:
+                for element in result:
+                    output_queue.put(element)
+            elif result is not None:
+                output_queue.put(result)
+            with lock:
+                stage.count += 1
+        except Exception as e:
+            with lock:
+                stage.errors.append(f'{type(e).__name__}: {e}')
+    with lock:
+        finished[0] += 1
+        last = finished[0] == stage.workers
+    if last:
+        for _ in range(next_workers):
+            output_queue.put(_STOP)
+
+
+def run_pipeline(source, stages: list, sink=None) -> dict:
+    """
+    run the stages concurrently, every stage is connected to the next one by a bounded queue.
+    :param source: an iterable of the items of the first stage.
+    :param stages: a list of `Stage`.
+    :param sink: a function of the items of the last stage, it is called in this thread. If None, they are dropped.
+    :return: a dict of stage name to {'count': the number of processed items, 'errors': error messages}.
+    """
+    queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages] + [queue.Queue(maxsize=16)]
+    threads = []
+    for i, stage in enumerate(stages):
+        next_workers = stages[i + 1].workers if i + 1 < len(stages) else 1
+        finished, lock = [0], threading.Lock()
+        for _ in range(stage.workers):
+            thread = threading.Thread(target=_run_stage, name=stage.name, daemon=True,
+                                      args=(stage, queues[i], queues[i + 1], next_workers, finished, lock))
+            thread.start()
+            threads.append(thread)
+
+    def feed():
+        for item in source:
+            queues[0].put(item)
+        for _ in range(stages[0].workers):
+            queues[0].put(_STOP)
+
+    feeder = threading.Thread(target=feed, name='source', daemon=True)
+    feeder.start()
+    while True:
+        item = queues[-1].get()
+        if item is _STOP:
+            break
+        if sink is not None:
+            sink(item)
+    feeder.join()
+    for thread in threads:
+        thread.join()
+    return {stage.name: {'count': stage.count, 'errors': stage.errors} for stage in stages}
+
+
+def match_files(file_paths: list, session_args: dict, sink, polygon=None, time_begin: int = None,
+                time_end: int = None, duration=120, minimum_point_size=10, read_workers=1, filter_workers=1,
+                segment_workers=1, match_workers=4, queue_size=16, max_speed=50.0, max_acceleration=None) -> dict:
+    """
+    import, filter, segment and match the data files in a pipeline. The files are read one car at a time by
+    `data_util.iter_car_points` and only queue_size items wait between two stages, so the memory does not grow with
+    the size and number of files. The match stage runs in match_workers processes, every process loads the match
+    session once, the ubodt is generated once before, see `match_util.prepare_session_args`.
+    :param file_paths: the data file paths, see `data_util.iter_car_points`.
+    :param session_args: the arguments of `match_util.MatchSession`.
+    :param sink: a function of (points_with_opath, fix_trajectory, error) of every segment, see
+    `match_util.match_fleet`.
+    :param polygon: if not None, remove the points not in the polygon.
+    :param time_begin: see `data_util.iter_car_points`.
+    :param time_end: see `data_util.iter_car_points`.
+    :param duration: see `data_util.preprocess_data`.
+    :param minimum_point_size: see `data_util.preprocess_data`.
+    :param read_workers: the number of threads of the read stage.
+    :param filter_workers: the number of threads of the filter stage.
+    :param segment_workers: the number of threads of the segment stage.
+    :param match_workers: the number of processes of the match stage.
+    :param queue_size: the maximum number of items between two stages.
+    :param max_speed: see `data_util.filter_outliers`. If None, the outliers are not removed.
+    :param max_acceleration: see `data_util.filter_outliers`. If None, only the duplicate time and speed rules are
+    used, the acceleration rule is opt-in.
+    :return: see `run_pipeline`, 'outliers' is the number of removed points of every rule of
+    `data_util.filter_outliers`.
+    """
+    outliers = {}
+    lock = threading.Lock()
+
+    def read(file_path):
+        return data_util.iter_car_points(file_path, time_begin, time_end)
+
+    def filter_points(points):
+        points = list(points)
+        if polygon is not None and len(points) != 0:
+            mask = data_util.contains_points(polygon, [point['longitude'] for point in points],
+                                             [point['latitude'] for point in points])
+            points = [point for point, valid in zip(points, mask) if valid]
+        if max_speed is not None and len(points) != 0:
+            points, counts = data_util.remove_outliers(points, max_speed, max_acceleration)
+            with lock:
+                for rule, count in counts.items():
+                    outliers[rule] = outliers.get(rule, 0) + count
+        return points
+
+    def segment(points):
+        return data_util.preprocess_data(points, duration, minimum_point_size)
+
+    session_args = match_util.prepare_session_args(session_args)
+    with ProcessPoolExecutor(max_workers=match_workers, initializer=match_util._init_worker,
+                             initargs=(session_args,)) as executor:
+        # start the workers before the stage threads: a worker forked while a stage thread holds a lock (e.g. of
+        # metrics_util) would wait for it forever.
+        for future in [executor.submit(os.getpid) for _ in range(match_workers)]:
+            future.result()
+
+        def match(points):
+            # one thread waits for one process, so at most match_workers segments are in flight.
+            chunk, metrics = executor.submit(match_util._match_chunk, [(0, points)]).result()
+            metrics_util.merge(metrics)
+            _, points_with_opath, fix_trajectory, error = chunk[0]
+            return points_with_opath, fix_trajectory, error
+
+        stages = [Stage('read', read, read_workers, queue_size, expand=True),
+                  Stage('filter', filter_points, filter_workers, queue_size),
+                  Stage('segment', segment, segment_workers, queue_size, expand=True),
+                  Stage('match', match, match_workers, queue_size)]
+        res = run_pipeline(file_paths, stages, lambda result: sink(*result))
+    res['outliers'] = outliers
+    return res
@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+'''
+@File        :   stream_util.py
+@Modify Time :   2023/3/6 14:20
+@Author      :   wyt
+@Version     :   1.0
+@Desciption  :   match live GPS points online
+'''
+from collections import OrderedDict, deque
+
+from util import metrics_util
+
+
+class OnlineMatcher:
+    """
+    An online matcher keeps a sliding window of the latest points of every vehicle and matches the window when a new
+    point arrives. A point is finalized once its matched edge has not changed for stable_rounds matches, or when it
+    leaves the window. At most max_vehicles vehicles are kept, so the memory is bounded by
+    max_vehicles * window_size points.
+    """
+
+    def __init__(self, session, window_size=30, stable_rounds=3, step=1, idle_timeout=300, max_vehicles=10000):
+        """
+        :param session: a loaded `match_util.MatchSession`, its network and ubodt are shared by all vehicles.
+        :param window_size: the maximum number of points matched for a vehicle.
+        :param stable_rounds: a point is finalized when its edge is the same in stable_rounds matches.
+        :param step: the window is matched every step new points of a vehicle.
+        :param idle_timeout: a vehicle is evicted by `evict_idle` if it has no point in idle_timeout seconds.
+        :param max_vehicles: the maximum number of vehicles. When it is exceeded, the least recently updated vehicle
+        is evicted.
+        """
+        self.session = session
+        self.window_size = window_size
+        self.stable_rounds = stable_rounds
+        self.step = step
+        self.idle_timeout = idle_timeout
+        self.max_vehicles = max_vehicles
+        # car_id -> {'window': deque of points, 'pending': new points since the last match, 'last_time': ...}
+        self._vehicles = OrderedDict()
+
+    def _match_window(self, window: deque):
+        """
+        match the window and update the edge and stable count of every point.
+        :param window: the points of a vehicle.
+        """
+        try:
+            opath = self.session.match_arrays([point['longitude'] for point in window],
+                                              [point['latitude'] for point in window])['opath'].tolist()
+        except Exception as e:
+            # the points stay unmatched and are matched again with the next points.
+            opath = [-1] * len(window)
+            metrics_util.count('segments_failed')
+            metrics_util.log('match_failed', car_id=window[-1]['car_id'], points=len(window),
+                             error=f'{type(e).__name__}: {e}')
+        for point, edge in zip(window, opath):
+            if edge != -1 and edge == point['opath']:
+                point['stable'] += 1
+            else:
+                point['opath'] = edge
+                point['stable'] = 0
+
+    @staticmethod
+    def _output(point: dict) -> dict:
+        """
+        :param point: a point in the window.
+        :return: a finalized point.
+        """
+        return {'car_id': point['car_id'], 'time': point['time'], 'longitude': point['longitude'],
+                'latitude': point['latitude'], 'opath': point['opath']}
+
+    def update(self, car_id: str, time: int, longitude: float, latitude: float) -> list:
+        """
+        add a new point of a vehicle. The points of a vehicle must arrive in time order, a point whose time is not
+        later than the vehicle's last point is dropped.
+        :param car_id: car id.
+        :param time: the time of the point.
+        :param longitude: longitude.
+        :param latitude: latitude.
+        :return: the finalized points, a list of dict with 'car_id', 'time', 'longitude', 'latitude' and 'opath'.
+        """
+        res = []
+        vehicle = self._vehicles.get(car_id)
+        if vehicle is None:
+            if len(self._vehicles) >= self.max_vehicles:
+                res += self._evict(next(iter(self._vehicles)))
+            vehicle = {'window': deque(), 'pending': 0, 'last_time': None}
+            self._vehicles[car_id] = vehicle
+        else:
+            self._vehicles.move_to_end(car_id)
+        if vehicle['last_time'] is not None and time <= vehicle['last_time']:
+            return res
+        vehicle['last_time'] = time
+        window = vehicle['window']
+        window.append({'car_id': car_id, 'time': time, 'longitude': longitude, 'latitude': latitude, 'opath': -1,
+                       'stable': 0, 'final': False})
+        vehicle['pending'] += 1
+        if vehicle['pending'] >= self.step and len(window) > 1:
+            vehicle['pending'] = 0
+            self._match_window(window)
+            # finalize in time order, a point waits until the points before it are finalized.
+            for point in window:
+                if point['final']:
+                    continue
+                if point['stable'] < self.stable_rounds:
+                    break
+                point['final'] = True
+                res.append(self._output(point))
+        while len(window) > self.window_size:
+            point = window.popleft()
+            if not point['final']:
+                res.append(self._output(point))
+        return res
+
+    def _evict(self, car_id: str) -> list:
+        """
+        remove a vehicle and finalize its points.
+        :param car_id: car id.
+        :return: the finalized points.
+        """
+        vehicle = self._vehicles.pop(car_id)
+        window = vehicle['window']
+        if vehicle['pending'] != 0 and len(window) > 1:
+            self._match_window(window)
+        return [self._output(point) for point in window if not point['final']]
+
+    def evict_idle(self, now: int) -> list:
+        """
+        evict the vehicles which have no point since now - idle_timeout.
+        :param now: the current time.
+        :return: the finalized points of the evicted vehicles.
+        """
+        res = []
+        for car_id in [car_id for car_id, vehicle in self._vehicles.items()
+                       if vehicle['last_time'] < now - self.idle_timeout]:
+            res += self._evict(car_id)
+        return res
+
+    def flush(self) -> list:
+        """
+        evict all the vehicles.
+        :return: the finalized points.
+        """
+        res = []
+        for car_id in list(self._vehicles):
+            res += self._evict(car_id)
+        return res
+
+    def __len__(self):
+        return len(self._vehicles)